@@ -1,16 +1,49 @@
 from yandex_music import Client
+from yandex_music.exceptions import NotFoundError
 from loguru import logger
-import requests
 import os
-import music_tag
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from dotenv import load_dotenv, find_dotenv
+from covers import CoverCache
+from library import Library
+from lyrics_cache import LyricsCache
+from manifest import Manifest
+from meta_cache import CachedClient
+from metrics import metrics
+from net import SessionRequest, _part_file, download_file, limits_stats, session_stats
+from pipeline import Pipeline
+from playlist_state import PlaylistState
+from subscriptions import Subscriptions
+from tags import id3_block, starts_with, write_tags
+from track_store import TrackStore, clone_file
 
 load_dotenv(find_dotenv())
-client = Client(token=os.getenv('YA_TOKEN'))
+client = CachedClient(Client(token=os.getenv('YA_TOKEN'), base_url=os.getenv('YA_API_URL'), request=SessionRequest()),
+                      ttl=int(os.getenv('META_CACHE_TTL', 3600)),
+                      max_items=int(os.getenv('META_CACHE_SIZE', 5000)),
+                      db_path=os.getenv('META_CACHE_DB'))
 client.init()
 folder_music = os.getenv('DOWNLOAD_PATH_MUSIC')
 folder_audiobooks = os.getenv('DOWNLOAD_PATH_BOOKS')
 folder_podcasts = os.getenv('DOWNLOAD_PATH_PODCASTS')
+download_threads = int(os.getenv('DOWNLOAD_THREADS', 4)) # сколько треков качаем одновременно (на все альбомы сразу)
+album_threads = int(os.getenv('ALBUM_THREADS', 2)) # сколько альбомов артиста обрабатываем одновременно
+tag_threads = int(os.getenv('TAG_THREADS', 2)) # сколько файлов одновременно тэгируем на диске
+pipeline_queue = int(os.getenv('PIPELINE_QUEUE', 32)) # сколько задач может ждать на входе каждой стадии конвейера
+tag_in_memory = os.getenv('TAG_IN_MEMORY', '0') == '1' # собирать тэг в памяти и писать его перед звуком одной записью
+covers = CoverCache(os.getenv('COVER_CACHE_DIR', f'{folder_music}/.covers'))
+library = Library(os.getenv('LIBRARY_DB', f'{folder_music}/.library.db')) # индекс скачанного для браузера /files
+folder_playlists = os.getenv('DOWNLOAD_PATH_PLAYLISTS', f'{folder_music}/Playlists')
+playlist_hardlinks = os.getenv('PLAYLIST_HARDLINKS', '0') == '1' # класть в папку плейлиста жёсткие ссылки на файлы альбомов
+track_store = TrackStore(os.getenv('TRACK_STORE_DB', f'{folder_music}/.tracks.db')) # готовые треки по id - для повторов в других альбомах
+lyrics_cache = LyricsCache(os.getenv('LYRICS_DB', f'{folder_music}/.lyrics.db'),
+                           negative_ttl=int(os.getenv('LYRICS_NEGATIVE_DAYS', 30)) * 86400) # тексты песен и «текста нет»
+lyrics_threads = int(os.getenv('LYRICS_THREADS', 2)) # сколько текстов песен запрашивать одновременно
+dedup_mode = os.getenv('DEDUP', 'copy') # copy - копия с диска со своими тэгами, hardlink - жёсткая ссылка, 0 - всегда качать
+requests_per_download = 3 # оценка запросов на закачку трека: варианты закачки, прямая ссылка, сам файл (без повторов)
+subscriptions = Subscriptions(os.getenv('SUBSCRIPTIONS_DB', f'{folder_music}/.subscriptions.db')) # подписки на подкасты
 wrong_symbols = r"#<$+%>!`&*‘|?{}“=>/:\@" # спецсимволы которые негативно влияют на создание каталогов и файлов
 # настройки логирования
 logger.add(f"{folder_music}/log.log",
@@ -34,12 +67,54 @@ def search_and_download_artist(search: str):
     logger.info(artist_echo) # вывод в лог
     # находим список альбомов артиста с информацией
     direkt_albums = client.artistsDirectAlbums(artist_id=artist_id, page_size=1000)
-    # проходимся по каждому альбому
-    for album in direkt_albums:
-        # проходимся по каждому диску в альбоме и загружаем его в папку
-        download_album(album['id'])
+    started = time.monotonic()
+    done, skipped, failed, saved = _download_albums({album['id']: None for album in direkt_albums},
+                                                    {album['id']: album['title'] for album in direkt_albums})
+    return _artist_summary(artist_id, artist_name, direkt_albums_count, done, skipped, failed, time.monotonic() - started, saved)
+
+
+def _download_albums(albums, titles=None, files=None):
+    """Качаем несколько альбомов одновременно, сами треки идут через общий конвейер.
+
+    albums - {album_id: id треков, которые нужны, или None - весь альбом}, titles - названия альбомов для сообщения об ошибке.
+    В files, если передан, складываются пути к готовым файлам треков: {track_id: файл}.
+    Возвращает названия скачанных, пропущенных (всё уже было) и альбомов с ошибками
+    и сколько треков и байт взято с диска вместо закачки.
+    """
+    titles = titles or {}
+    done, skipped, failed, saved = [], [], [], [0, 0]
+    with ThreadPoolExecutor(max_workers=album_threads) as pool:
+        futures = {pool.submit(_download_album, album_id, track_ids): album_id for album_id, track_ids in albums.items()}
+        for future in as_completed(futures):
+            try:
+                stat = future.result()
+            except Exception:
+                album_id = futures[future]
+                logger.exception(f"Album ID: {album_id} {titles.get(album_id, '')} failed")
+                failed.append(titles.get(album_id, str(album_id)))
+                continue
+            if files is not None:
+                files.update(stat['files'])
+            saved[0] += stat['linked']
+            saved[1] += stat['saved_bytes']
+            if stat['failed']:
+                failed.append(stat['title'])
+            elif stat['downloaded'] or stat['linked']:
+                done.append(stat['title'])
+            else:
+                skipped.append(stat['title'])
+    return done, skipped, failed, tuple(saved)
+
 
-    return f"Успешно скачал артиста: {artist_name} с его {direkt_albums_count} альбомами."
+def _artist_summary(artist_id, artist_name, albums_count, done, skipped, failed, elapsed, saved=(0, 0)):
+    """Пишем в лог итоги закачки артиста и собираем сообщение для бота"""
+    artist_stat_echo = f"Artist ID: {artist_id} done in {elapsed:.1f} s: albums done {len(done)}, skipped {len(skipped)}, failed {len(failed)}, tracks from disk {saved[0]} ({saved[1]} bytes)"
+    logger.info(artist_stat_echo) # вывод в лог
+    mess = f"Успешно скачал артиста: {artist_name} с его {albums_count} альбомами за {elapsed / 60:.1f} мин." \
+           f"\nскачано: {len(done)}, уже были: {len(skipped)}, с ошибками: {len(failed)}" + _saved_message(*saved)
+    if failed:
+        mess += '\nНе удалось скачать: ' + ', '.join(failed)
+    return mess
 
 @logger.catch
 def get_album_info(album_id):
@@ -48,119 +123,539 @@ def get_album_info(album_id):
     return f"Альбом: {album['title']}\nартист:{', '. join([art['name'] for art in album['artists']])} \
             \nколичество треков: {album['track_count']}"
 
-@logger.catch
-def download_album(album_id):
-    "Скачиваем альбом"
-    album = client.albumsWithTracks(album_id=album_id)
-    album_echo = f"Album ID: {album['id']} / Album title - {album['title']}"
-    logger.info(album_echo) # вывод в лог
-    #создаем папку для альбома
+def _best_download_info(track_id):
+    """Узнаём варианты закачки трека и получаем прямую ссылку только для лучшего битрейта.
+
+    get_direct_links=True делает запрос за ссылкой на каждый вариант (кодек/битрейт), а нужен нам один.
+    """
+    with metrics.timer('stage_seconds', stage='link'):
+        track_info = client.tracks_download_info(track_id=track_id) # узнаем информацию о треке
+        track_info.sort(reverse=True, key=lambda key: key['bitrate_in_kbps'])
+        track_info[0].get_direct_link()
+    return track_info[0]
+
+
+def _album_folder(album):
+    """Папка альбома и папка артиста (None для сборников)"""
     if album['artists'][0]['various']:
-        album_folder = f"{folder_music}/Various artist/{album['title']} ({album['year']})"
+        return f"{folder_music}/Various artist/{album['title']} ({album['year']})", None
+    artist_folder = f"{folder_music}/{album['artists'][0]['name']}"
+    return f"{artist_folder}/{''.join([_ for _ in album['title'] if _ not in wrong_symbols])} ({album['year']})", artist_folder
+
+
+def _album_track_info(track, tag_info, album, album_folder):
+    """Собираем тэги трека альбома и путь к его файлу"""
+    info = {
+        'title': tag_info['title'],
+        'volume_number': track['albums'][0]['track_position']['volume'],
+        'total_volumes': len(album['volumes']),
+        'track_position': track['albums'][0]['track_position']['index'],
+        'total_track': album['track_count'],
+        'genre': tag_info['albums'][0]['genre'],
+        'artist': ', '. join([art['name'] for art in tag_info['artists']]),
+        'album_artist': [artist['name'] for artist in album['artists']],
+        'album': album['title'],
+    }
+    if album['release_date']:
+        info['album_year'] = album['release_date'][:10]
+    elif album['year']:
+        info['album_year'] = album['year']
     else:
-        artist_id = album['artists'][0]['id']
-        artist_name = album['artists'][0]['name']
-        artist_cover_link = client.artistsBriefInfo(artist_id=artist_id)['artist']['cover']['uri'].replace('%%',
-                                                                                                           '1000x1000')
-        artist_folder = f"{folder_music}/{artist_name}"
-        artist_cover_pic = f"{artist_folder}/artist.jpg"
+        info['album_year'] = ''
 
-        os.makedirs(os.path.dirname(f"{artist_folder}/"), exist_ok=True)
-        with open(artist_cover_pic, 'wb') as f:  # качаем обложку артиста
-            rec = requests.get('http://' + artist_cover_link)
-            f.write(rec.content)
+    disk_folder = f"{album_folder}/Disk {info['volume_number']}"
+    track_file = f"{disk_folder}/{info['track_position']} - {''.join([ _ for _ in info['title'] if _ not in wrong_symbols])}.mp3"
+    return info, track_file
+
+
+def _album_tags(mp3, info, album, tag_info, album_cover, lyrics=None):
+    """Тэги, текст песни и обложка трека альбома"""
+    mp3['tracktitle'] = info['title']
+    if album['version'] is not None:
+        mp3['album'] = info['album'] + ' ' + album['version']
+    else:
+        mp3['album'] = info['album']
+    mp3['discnumber'] = info['volume_number']
+    mp3['totaldiscs'] = info['total_volumes']
+    mp3['tracknumber'] = info['track_position']
+    mp3['totaltracks'] = info['total_track']
+    mp3['genre'] = info['genre']
+    mp3['Year'] = info['album_year']
+    if tag_info['version'] is not None:
+        mp3['comment'] = f"{tag_info['version']} / Release date {info['album_year']}"
+    else:
+        mp3['comment'] = f"Release date {info['album_year']}"
+    mp3['artist'] = info['artist']
+    mp3['album_artist'] = info['album_artist']
+    if lyrics:
+        mp3['lyrics'] = lyrics
+    mp3['artwork'] = album_cover #ложим картинку в тег "artwork"
+
+
+def _fetch_lyrics(track_id):
+    """Текст песни, False - если его нет, None - если узнать не удалось (спросим в другой раз)"""
+    lyrics = lyrics_cache.get(track_id)
+    if lyrics is not None:
+        return lyrics
+    try:
+        lyrics = client.tracks_lyrics(track_id=track_id).fetch_lyrics()
+    except NotFoundError:
+        lyrics = False
+    except Exception: # сеть, таймаут, неожиданный ответ - не кэшируем, спросим в другой раз
+        logger.exception(f"Lyrics of track ID: {track_id} failed")
+        return None
+    lyrics_cache.put(track_id, lyrics)
+    return lyrics
+
+
+def _lyrics_tag(mp3, lyrics):
+    mp3['lyrics'] = lyrics
+
+
+def _write_lyrics_file(track_file, lyrics):
+    """Кладём текст песни рядом с треком"""
+    with open(track_file.replace('.mp3', '.txt'), 'w', encoding='UTF8') as text_song:
+        text_song.write(lyrics)
+
+
+# Стадии конвейера. Задача - dict: id, title, track_file, folder (папка манифеста), manifest,
+# fill_tags(mp3) и with_lyrics. Стадия возвращает имя следующей стадии или None.
+# Текст песни - отдельная задача стадии lyrics, её закачка альбома не ждёт; текст, уже лежащий в кэше,
+# сразу идёт в тэги (job['lyrics']), и отдельная перезапись файла ради него не нужна.
+
+def _remember_track(job):
+    """Готовый трек (с тэгами) - в индекс, чтобы его повторы в других альбомах брались с диска"""
+    entry = job['manifest'].get(job['id'])
+    if entry.get('sha1'):
+        track_store.add(job['id'], job['track_file'], entry['sha1'], entry['size'], entry.get('bitrate'))
+
+
+def _track_done(job):
+    """Трек готов: в индекс для повторов и, если нужно, в очередь за текстом песни"""
+    _remember_track(job)
+    entry = job['manifest'].get(job['id'])
+    if job.get('with_lyrics') and entry.get('tagged') and 'lyrics' not in entry:
+        if job.get('lyrics') is not None: # текст (или отметка «нет») из кэша уже записан с тэгами
+            if job['lyrics']:
+                _write_lyrics_file(job['track_file'], job['lyrics'])
+            job['manifest'].update(job['id'], lyrics=bool(job['lyrics']))
+            return
+        # текст - отдельной задачей: очередь стадии lyrics не ограничена, и звук её никогда не ждёт
+        pipeline.submit({'id': job['id'], 'title': job['title'], 'track_file': job['track_file'],
+                         'manifest': job['manifest']}, stage='lyrics')
+
+
+def _cached_lyrics(job):
+    """Текст песни из кэша - в fill_tags, чтобы он лёг в файл вместе с остальными тэгами"""
+    if job.get('with_lyrics') and 'lyrics' not in job:
+        job['lyrics'] = lyrics_cache.get(job['id']) # None - в кэше нет, спросит стадия lyrics
+        if job['lyrics']:
+            job['fill_tags'] = partial(job['fill_tags'], lyrics=job['lyrics'])
+
+
+def _stage_resolve(job):
+    """Стадия resolve (сеть): пропускаем готовое, узнаём прямую ссылку или находим трек в другом альбоме"""
+    manifest, track_file = job['manifest'], job['track_file']
+    # проверяем существование трека на сервере (или скачан ещё до появления манифеста)
+    if manifest.is_done(job['id']) or (os.path.exists(track_file) and not manifest.get(job['id'])):
+        track_echo_ok = "Track already exists. Continue."
+        logger.info(track_echo_ok)
+        _track_done(job) # скачанное раньше попадает в индекс и получает текст при следующем проходе
+        return None
+    os.makedirs(os.path.dirname(track_file), exist_ok=True)
+    if manifest.is_downloaded(job['id'], track_file):
+        track_echo_ok = "Track already downloaded. Start write tag's."
+        logger.info(track_echo_ok)
+        return 'tag'
+    if dedup_mode != '0':
+        job['source'] = track_store.find(job['id'], exclude=track_file)
+        if job['source']:
+            return 'dedup'
+    job['track_info'] = _best_download_info(job['id'])
+    return 'download'
+
+
+def _stage_dedup(job):
+    """Стадия dedup (диск): трек уже есть в другом альбоме - берём его файл вместо закачки.
+
+    hardlink - жёсткая ссылка, тэги остаются от первой копии; иначе копия (reflink, где ФС умеет)
+    и стадия tag пишет в неё тэги этого альбома.
+    """
+    source, sha1, size, bitrate = job['source']
+    part = _part_file(job['track_file'])
+    if os.path.exists(part):
+        os.remove(part)
+    tagged = False
+    if dedup_mode == 'hardlink':
+        try:
+            os.link(source, part)
+            tagged = True
+        except OSError: # другая файловая система - делаем копию
+            logger.exception(f"Hardlink {source} failed")
+    if not tagged:
+        clone_file(source, part)
+    os.replace(part, job['track_file'])
+    job['manifest'].update(job['id'], file=os.path.relpath(job['track_file'], job['folder']), size=size,
+                           bitrate=bitrate, sha1=sha1, tagged=tagged, file_size=os.path.getsize(job['track_file']))
+    job['linked'] = size
+    logger.info(f"Track ID: {job['id']} taken from {source} instead of download")
+    if tagged:
+        _track_done(job)
+        return None
+    return 'tag'
+
+
+def _stage_download(job):
+    """Стадия download (сеть): качаем файл и отмечаем его в манифесте.
+
+    При TAG_IN_MEMORY тэг собирается в памяти и ложится в файл перед звуком, и стадия tag не нужна.
+    """
+    track_info = job['track_info']
+    track_echo = f"Start Download: ID: {job['id']} {job['title']} bitrate: {track_info['bitrate_in_kbps']} {track_info['direct_link']}"
+    logger.info(track_echo) # вывод в лог
+    if tag_in_memory:
+        _cached_lyrics(job)
+    header = id3_block(job['fill_tags']) if tag_in_memory else b''
+    size, sha1 = download_file(track_info['direct_link'], job['track_file'], header=header)
+    tagged = starts_with(job['track_file'], header)
+    job['manifest'].update(job['id'], file=os.path.relpath(job['track_file'], job['folder']), size=size,
+                           bitrate=track_info['bitrate_in_kbps'], sha1=sha1, tagged=tagged,
+                           file_size=os.path.getsize(job['track_file']))
+    job['result'] = size
+    if tagged:
+        track_echo_ok = "Track downloaded with tag's."
+        logger.info(track_echo_ok)  # вывод в лог
+        _track_done(job)
+        return None
+    track_echo_ok = "Track downloaded. Start write tag's."
+    logger.info(track_echo_ok)  # вывод в лог
+    return 'tag'
+
+
+def _stage_tag(job):
+    """Стадия tag (диск): пишем тэги и обложку, сеть в это время качает следующие треки"""
+    _cached_lyrics(job)
+    write_tags(job['track_file'], job['fill_tags'])
+    job['manifest'].update(job['id'], tagged=True, file_size=os.path.getsize(job['track_file']))
+    tags_echo = "Tag's is writed"
+    logger.info(tags_echo)  # вывод в лог
+    _track_done(job)
+    return None
+
+
+def _stage_lyrics(job):
+    """Стадия lyrics (сеть, кэш): текст песни в тэг lyrics и файлом рядом с треком"""
+    try:
+        lyrics = _fetch_lyrics(job['id'])
+        if lyrics is None:
+            return None
+        if lyrics:
+            _write_lyrics_file(job['track_file'], lyrics)
+            # файл с жёсткими ссылками не трогаем: его размер записан и в манифестах других альбомов
+            if os.stat(job['track_file']).st_nlink == 1:
+                write_tags(job['track_file'], partial(_lyrics_tag, lyrics=lyrics))
+        job['manifest'].update(job['id'], lyrics=bool(lyrics), file_size=os.path.getsize(job['track_file']))
+    except Exception: # текст необязателен: ошибку только в лог, трек остаётся готовым
+        logger.exception(f"Lyrics of track ID: {job['id']} {job['title']} failed")
+    return None
+
+
+# общий конвейер: сколько бы альбомов/книг ни качалось одновременно, в сети не больше download_threads задач на стадию,
+# а запись тэгов идёт в своём пуле и не занимает сетевые потоки
+pipeline = Pipeline()
+pipeline.add_stage('resolve', _stage_resolve, download_threads, pipeline_queue)
+pipeline.add_stage('download', _stage_download, download_threads, pipeline_queue)
+pipeline.add_stage('dedup', _stage_dedup, tag_threads, pipeline_queue)
+pipeline.add_stage('tag', _stage_tag, tag_threads, pipeline_queue)
+pipeline.add_stage('lyrics', _stage_lyrics, lyrics_threads, 0)
+metrics.gauge('pipeline_queue', lambda: {name: stage['queue'] for name, stage in pipeline.stats().items()}, label='stage')
+
+
+def _wait_jobs(jobs):
+    """Ждём задачи конвейера. Возвращает (скачано, пропущено, с ошибками, байт)"""
+    downloaded, skipped, failed, total_bytes = 0, 0, 0, 0
+    futures = {job['future']: job for job in jobs}
+    for future in as_completed(futures):
+        job = futures[future]
+        try:
+            size = future.result()
+        except Exception:
+            logger.exception(f"Track ID: {job['id']} {job['title']} failed")
+            failed += 1
+            continue
+        job['ok'] = True
+        if size:
+            downloaded += 1
+            total_bytes += size
+        else:
+            skipped += 1
+    logger.info(f"Pipeline: {pipeline.stats()}")
+    return downloaded, skipped, failed, total_bytes
 
-        album_folder = f"{artist_folder}/{''.join([_ for _ in album['title'] if _ not in wrong_symbols])} ({album['year']})"
+
+def _download_album(album_id, track_ids=None):
+    """Скачиваем альбом (или только треки track_ids из него) и возвращаем статистику закачки"""
+    with metrics.timer('stage_seconds', stage='metadata'):
+        album = client.albumsWithTracks(album_id=album_id)
+    album_echo = f"Album ID: {album['id']} / Album title - {album['title']}"
+    logger.info(album_echo) # вывод в лог
+    #создаем папку для альбома
+    album_folder, artist_folder = _album_folder(album)
+    if artist_folder:
+        artist_cover_uri = client.artistsBriefInfo(artist_id=album['artists'][0]['id'])['artist']['cover']['uri']
+        os.makedirs(os.path.dirname(f"{artist_folder}/"), exist_ok=True)
+        covers.save(artist_cover_uri, f"{artist_folder}/artist.jpg") # качаем обложку артиста, из сети - один раз на артиста
 
     os.makedirs(os.path.dirname(f"{album_folder}/"),exist_ok=True)
     album_cover_pic = f"{album_folder}/cover.jpg"
-    # качаем обложку альбома
-    with open(album_cover_pic, 'wb') as f:
-        rec = requests.get('http://' + album['cover_uri'].replace('%%', '1000x1000'))
-        f.write(rec.content)
-
-    # проходимся по каждому диску в альбоме
-
-    n_volume = 1
-    for disk in album['volumes']:
-        disk_echo = f"Start download: Volume №: {n_volume} из {len(album['volumes'])}"
-        logger.info(disk_echo) # вывод в лог
-        n_volume += 1
-
-        for track in disk: # проходимся по каждому треку в диске
-            track_info = client.tracks_download_info(track_id=track['id'], get_direct_links=True) # узнаем информацию о треке
-            track_info.sort(reverse=True, key=lambda key: key['bitrate_in_kbps'])
-            track_echo = f"Start Download: ID: {track['id']} {track['title']} bitrate: {track_info[0]['bitrate_in_kbps']} {track_info[0]['direct_link']}"
-            logger.info(track_echo) # вывод в лог
-            tag_info = client.tracks(track['id'])[0]
-            info = {
-                'title': tag_info['title'],
-                'volume_number': track['albums'][0]['track_position']['volume'],
-                'total_volumes': len(album['volumes']),
-                'track_position': track['albums'][0]['track_position']['index'],
-                'total_track': album['track_count'],
-                'genre': tag_info['albums'][0]['genre'],
-                'artist': ', '. join([art['name'] for art in tag_info['artists']]),
-                'album_artist': [artist['name'] for artist in album['artists']],
-                'album': album['title'],
-            }
-            if album['release_date']:
-                info['album_year'] = album['release_date'][:10]
-            elif album['year']:
-                info['album_year'] = album['year']
-            else:
-                info['album_year'] = ''
-
-            disk_folder = f"{album_folder}/Disk {info['volume_number']}"
-            os.makedirs(os.path.dirname(f"{disk_folder}/"), exist_ok=True)
-            track_file = f"{disk_folder}/{info['track_position']} - {''.join([ _ for _ in info['title'] if _ not in wrong_symbols])}.mp3"
-            # проверяем существование трека на сервере
-            if os.path.exists(track_file):
-                track_echo_ok = "Track already exists. Continue."
-                logger.info(track_echo_ok)
-                continue
+    # качаем обложку альбома, её байты один раз на альбом идут в тэг каждого трека
+    album_cover = covers.save(album['cover_uri'], album_cover_pic)
+
+    # собираем треки всех дисков и отдаём их в конвейер
+    tracks = [track for disk in album['volumes'] for track in disk]
+    if track_ids is not None:
+        tracks = [track for track in tracks if str(track['id']) in track_ids]
+    disk_echo = f"Start download: Volumes: {len(album['volumes'])} / Tracks: {len(tracks)} / Threads: {download_threads}, tag threads: {tag_threads}"
+    logger.info(disk_echo) # вывод в лог
+
+    started = time.monotonic()
+    manifest = Manifest(album_folder)
+    # тэги всех треков альбома одним запросом (треки из albumsWithTracks уже лежат в кэше клиента)
+    with metrics.timer('stage_seconds', stage='metadata'):
+        tag_infos = {str(tag_info['id']): tag_info for tag_info in client.tracks([track['id'] for track in tracks])}
+    jobs = []
+    for track in tracks:
+        tag_info = tag_infos.get(str(track['id']), track)
+        info, track_file = _album_track_info(track, tag_info, album, album_folder)
+        fill_tags = partial(_album_tags, info=info, album=album, tag_info=tag_info, album_cover=album_cover)
+        job = {'id': track['id'], 'title': track['title'], 'track_file': track_file, 'folder': album_folder,
+               'manifest': manifest, 'fill_tags': fill_tags, 'with_lyrics': True}
+        pipeline.submit(job)
+        jobs.append(job)
+    downloaded, skipped, failed, total_bytes = _wait_jobs(jobs)
+    library.scan(artist_folder or album_folder)
+
+    logger.info(f"HTTP pool: {session_stats()} / Limits: {limits_stats()} / Covers: {covers.stats()} / Metadata: {client.stats()}")
+    linked = [job['linked'] for job in jobs if job.get('ok') and job.get('linked')]
+    stat = _album_stat(album, downloaded, skipped, failed, total_bytes, time.monotonic() - started, len(linked), sum(linked))
+    stat['files'] = {str(job['id']): job['track_file'] for job in jobs if job.get('ok')}
+    return stat
+
+
+def _saved_message(linked, saved_bytes):
+    """Сколько сэкономили на треках, которые уже были в других альбомах"""
+    if not linked:
+        return ''
+    return f"\nвзято с диска вместо закачки: {linked} треков, {saved_bytes / 1024 / 1024:.1f} МБ, запросов: примерно {linked * requests_per_download}"
+
+
+def _album_stat(album, downloaded, skipped, failed, total_bytes, elapsed, linked=0, saved_bytes=0):
+    """Пишем в лог скорость закачки альбома и возвращаем его статистику"""
+    speed = total_bytes / elapsed / 1024 / 1024 if elapsed else 0
+    album_stat_echo = f"Album ID: {album['id']} done in {elapsed:.1f} s: downloaded {downloaded}, skipped {skipped}, failed {failed} / {total_bytes / 1024 / 1024:.1f} MB, {speed:.2f} MB/s, {downloaded / elapsed if elapsed else 0:.2f} tracks/s / from disk {linked} ({saved_bytes / 1024 / 1024:.1f} MB, ~{linked * requests_per_download} requests avoided, estimate)"
+    logger.info(album_stat_echo) # вывод в лог
+    return {
+        'title': album['title'],
+        'track_count': album['track_count'],
+        'downloaded': downloaded,
+        'skipped': skipped,
+        'failed': failed,
+        'bytes': total_bytes,
+        'elapsed': elapsed,
+        'linked': linked,
+        'saved_bytes': saved_bytes,
+    }
+
+
+def _album_message(stat):
+    mess = f"Успешно скачал альбом/сборник: {stat['title']} с его {stat['track_count']} композициями."
+    mess += _saved_message(stat['linked'], stat['saved_bytes'])
+    if stat['failed']:
+        mess += f"\nНе удалось скачать треков: {stat['failed']}. Посмотри log"
+    return mess
 
-            client.request.download(
-                url=track_info[0]['direct_link'],
-                filename=track_file
-            )
-            track_echo_ok = "Track downloaded. Start write tag's."
-            logger.info(track_echo_ok)  # вывод в лог
-
-            # начинаем закачивать тэги в трек
-            mp3 = music_tag.load_file(track_file)
-            mp3['tracktitle'] = info['title']
-            if album['version'] is not None:
-                mp3['album'] = info['album'] + ' ' + album['version']
-            else:
-                mp3['album'] = info['album']
-            mp3['discnumber'] = info['volume_number']
-            mp3['totaldiscs'] = info['total_volumes']
-            mp3['tracknumber'] = info['track_position']
-            mp3['totaltracks'] = info['total_track']
-            mp3['genre'] = info['genre']
-            mp3['Year'] = info['album_year']
-            if tag_info['version'] is not None:
-                mp3['comment'] = f"{tag_info['version']} / Release date {info['album_year']}"
+
+@logger.catch
+def download_album(album_id):
+    "Скачиваем альбом"
+    return _album_message(_download_album(album_id))
+
+
+@logger.catch
+def backfill_lyrics(folder=None):
+    """Докачиваем тексты песен ко всем уже скачанным трекам папки (по умолчанию - всей музыки)"""
+    folder = folder or folder_music
+    jobs = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if Manifest.file_name not in files:
+            continue
+        manifest = Manifest(root)
+        for track_id in manifest.done_ids():
+            entry = manifest.get(track_id)
+            track_file = os.path.join(root, entry['file'])
+            # «текста нет» тоже проверяем заново: кэш ответит сам, пока отметка не устарела
+            if not entry.get('lyrics') and os.path.exists(track_file):
+                job = {'id': track_id, 'title': entry['file'], 'track_file': track_file, 'manifest': manifest}
+                pipeline.submit(job, stage='lyrics')
+                jobs.append(job)
+    failed = _wait_jobs(jobs)[2]
+    found = sum(1 for job in jobs if job['manifest'].get(job['id']).get('lyrics'))
+    logger.info(f"Lyrics backfill {folder}: tracks {len(jobs)}, found {found}, failed {failed} / cache {lyrics_cache.stats()}")
+    mess = f"Проверил тексты песен у {len(jobs)} треков, нашёл {found}"
+    if failed:
+        mess += f"\nНе удалось: {failed}. Посмотри log"
+    return mess
+
+
+@logger.catch
+def download_track(track_id):
+    """Скачиваем один трек в папку его альбома"""
+    track = client.tracks([track_id])[0]
+    stat = _download_album(track['albums'][0]['id'], track_ids={str(track_id)})
+    if stat['failed']:
+        return f"Не удалось скачать трек: {track['title']}. Посмотри log"
+    return f"Успешно скачал трек: {track['title']} из альбома {stat['title']}"
+
+
+def _playlist(playlist_id, revision=None):
+    """Плейлист по id из ссылки: owner:kind, uuid, likes или owner:likes - «Мне нравится».
+
+    Возвращает название, ревизию и треки [(track_id, album_id)] по порядку
+    или None, если ревизия не изменилась с revision - тогда треки и не запрашиваются.
+    """
+    owner, _, kind = playlist_id.rpartition(':')
+    if kind == 'likes':
+        likes = client.users_likes_tracks(user_id=owner or None, if_modified_since_revision=revision or 0)
+        if likes is None or likes.revision == revision:
+            return None
+        return 'Мне нравится', likes.revision, [(str(track.id), track.album_id) for track in likes]
+    if owner:
+        # сначала только заголовок плейлиста, без треков: ночью плейлист обычно не меняется
+        if revision is not None:
+            heads = client.users_playlists([kind], owner)
+            if heads and heads[0].revision == revision:
+                return None
+        playlist = client.users_playlists(kind, owner)
+    else:
+        playlist = client.playlist(playlist_id)
+        if playlist.revision == revision:
+            return None
+    tracks = []
+    for track_short in playlist.tracks or playlist.fetch_tracks():
+        album_id = track_short.album_id or (track_short.track and track_short.track.albums and track_short.track.albums[0].id)
+        tracks.append((str(track_short.id), album_id))
+    return playlist.title, playlist.revision, tracks
+
+
+def _playlist_file(state, track_id, track_file, links_folder):
+    """Файл трека для плейлиста: жёсткая ссылка в папке плейлиста или сам файл в папке альбома"""
+    if playlist_hardlinks:
+        os.makedirs(links_folder, exist_ok=True)
+        link = os.path.join(links_folder, os.path.basename(track_file))
+        if os.path.exists(link) and not os.path.samefile(link, track_file):
+            link = os.path.join(links_folder, f"{track_id} {os.path.basename(track_file)}")
+        try:
+            if not os.path.exists(link):
+                os.link(track_file, link)
+            track_file = link
+        except OSError: # другая файловая система или ссылки не поддерживаются - сошлёмся на сам файл
+            logger.exception(f"Hardlink {link} failed")
+    return os.path.relpath(track_file, state.folder)
+
+
+def _write_m3u(state, title, tracks):
+    """Пишем M3U плейлиста по порядку треков; пути относительные, чтобы папку можно было перенести целиком"""
+    m3u = ''.join([_ for _ in title if _ not in wrong_symbols]) + '.m3u8'
+    lines = ['#EXTM3U']
+    for track_id, _ in tracks:
+        if state.has(track_id):
+            path = state.files[track_id]
+            lines.append(f"#EXTINF:-1,{os.path.splitext(os.path.basename(path))[0]}")
+            lines.append(path.replace(os.sep, '/'))
+    tmp_path = os.path.join(state.folder, '.' + m3u + '.tmp')
+    with open(tmp_path, 'w', encoding='UTF8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, os.path.join(state.folder, m3u))
+    if state.m3u and state.m3u != m3u and os.path.exists(os.path.join(state.folder, state.m3u)):
+        os.remove(os.path.join(state.folder, state.m3u)) # плейлист переименовали
+    state.m3u = m3u
+
+
+@logger.catch
+def download_playlist(playlist_id):
+    """Синхронизируем плейлист или «Мне нравится» с папкой плейлистов.
+
+    Качаются только треки, добавленные с прошлой синхронизации, каждый в папку своего альбома;
+    то, что уже лежит в альбомах, не качается заново. Удалённые из плейлиста треки убираются из M3U.
+    """
+    os.makedirs(folder_playlists, exist_ok=True)
+    state = PlaylistState(folder_playlists, playlist_id)
+    synced = state.m3u and os.path.exists(os.path.join(folder_playlists, state.m3u))
+    playlist = _playlist(playlist_id, state.revision if synced else None)
+    if playlist is None:
+        logger.info(f"Playlist ID: {playlist_id} not changed since revision {state.revision}")
+        return f"Плейлист {playlist_id} не изменился с прошлой синхронизации"
+    title, revision, tracks = playlist
+    links_folder = os.path.join(folder_playlists, ''.join([_ for _ in title if _ not in wrong_symbols]))
+    # удалённые из плейлиста: забываем, а свои жёсткие ссылки удаляем (файлы в альбомах не трогаем)
+    current = {track_id for track_id, _ in tracks}
+    removed = [track_id for track_id in state.files if track_id not in current]
+    for track_id in removed:
+        path = os.path.join(folder_playlists, state.files.pop(track_id))
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(links_folder) and os.path.exists(path):
+            os.remove(path)
+    albums, no_album = {}, 0
+    for track_id, album_id in tracks:
+        if state.has(track_id):
+            continue
+        if album_id:
+            albums.setdefault(album_id, set()).add(track_id)
+        else:
+            no_album += 1
+    added = sum(len(track_ids) for track_ids in albums.values())
+    logger.info(f"Playlist ID: {playlist_id} / Playlist title - {title} / revision {state.revision} -> {revision}"
+                f" / tracks: {len(tracks)}, added: {added}, removed: {len(removed)}")
+    files = {}
+    done, skipped, failed, saved = _download_albums(albums, files=files)
+    for track_id, track_file in files.items():
+        state.files[track_id] = _playlist_file(state, track_id, track_file, links_folder)
+    _write_m3u(state, title, tracks)
+    # с ошибками ревизию не запоминаем: не скачанное попробуем в следующий раз
+    if not failed:
+        state.revision = revision
+    state.save()
+    library.scan(folder_playlists)
+    mess = f"Синхронизировал плейлист: {title} ({len(tracks)} треков)" \
+           f"\nдобавлено: {len(files)} из {added} новых, удалено: {len(removed)}"
+    if failed:
+        mess += '\nНе удалось скачать альбомы: ' + ', '.join(failed)
+    mess += _saved_message(*saved)
+    if no_album:
+        mess += f"\nБез альбома (не скачать): {no_album}"
+    return mess
+
+
+def album_kinds(album_ids):
+    """Тип каждого альбома по id (Album, Book или Podcast) и скачан ли он уже целиком.
+
+    Альбомы запрашиваются пачками, без треков: для сотни ссылок это пара запросов, а не сотня.
+    Подкасты уже скачанными не считаются - у них появляются новые выпуски.
+    """
+    kinds = {}
+    for n in range(0, len(album_ids), 100):
+        for album in client.albums(album_ids[n:n + 100]):
+            if _is_podcast(album):
+                kinds[str(album['id'])] = ('Podcast', False)
+                continue
+            if 'audiobook' in (album['meta_type'], album['type']):
+                kind, folder = 'Book', _book_info(album)[1]
             else:
-                mp3['comment'] = f"Release date {info['album_year']}"
-            mp3['artist'] = info['artist']
-            mp3['album_artist'] = info['album_artist']
-            try:
-                lyrics = client.tracks_lyrics(track_id=track['id'], format='TEXT').fetch_lyrics()
-            except:
-                lyrics = False
-            if lyrics:
-                with open(track_file.replace('.mp3', '.txt'), 'w', encoding='UTF8') as text_song:
-                    text_song.write(lyrics)
-                mp3['lyrics'] = lyrics
-            with open(album_cover_pic, 'rb') as img_in:               #ложим картинку в тег "artwork"
-                mp3['artwork'] = img_in.read()
-
-            mp3.save()
-            tags_echo = "Tag's is writed"
-            logger.info(tags_echo)  # вывод в лог
-    return f"Успешно скачал альбом/сборник: {info['album']} с его {info['total_track']} композициями."
+                kind, folder = 'Album', _album_folder(album)[0]
+            # сначала индекс библиотеки (без диска), манифест читаем, только если папка там есть
+            downloaded = library.has(folder) and Manifest(folder).done_count() >= (album['track_count'] or 1)
+            kinds[str(album['id'])] = (kind, downloaded)
+    return kinds
 
 
 @logger.catch
@@ -170,10 +665,8 @@ def get_book_info(album_id):
     return f"Аудиокнига:\n{book['title']}\nсодержание из {book['track_count']} частей."
 
 
-@logger.catch
-def download_book(album_id):
-    """Скачиваем аудиокнигу"""
-    s = client.albumsWithTracks(album_id=album_id)
+def _book_info(s):
+    """Разбираем название книги на автора и заголовок, собираем тэги книги и путь к её папке"""
     info_book = {}
 
     for i in range(len(s['title'])):
@@ -189,78 +682,75 @@ def download_book(album_id):
             info_book['book_title'] = s['title']
 
     info_book['artists'] = ", ".join([x['name'] for x in s['artists']])
-    info_book['cover_url'] = 'https://' + s['cover_uri'].replace('%%', '1000x1000')
     info_book['parts'] = s['track_count']
     if s['labels']:
         info_book['labels'] = s['labels'][0]['name']
     info_book['description'] = s['description']
-    
-    author_echo = f"Author: {info_book['author']}"
-    logger.info(author_echo) # вывод в лог
-    book_echo = f"Book ID: {album_id} / Book title - {info_book['book_title']}"
-    logger.info(book_echo)  # вывод в лог
-    
+
     folder_author = f"{folder_audiobooks}/{info_book['author']}"
     if len(info_book['book_title']) > 50:
         info_book['short_book_title'] = info_book['book_title'][:50]+'...'
         folder_book = f"{folder_author}/{''.join([ _ for _ in info_book['short_book_title'] if _ not in wrong_symbols])}/"
     else:
         folder_book = f"{folder_author}/{''.join([ _ for _ in info_book['book_title'] if _ not in wrong_symbols])}/"
-    
+    return info_book, folder_book
+
+
+def _book_part_file(folder_book, part):
+    """Путь к файлу части аудиокниги"""
+    part_name = ''.join([ _ for _ in part['title'] if _ not in wrong_symbols])
+    if len(part['title']) > 50:
+        return f"{folder_book}/{part['albums'][0]['track_position']['index']} - {part_name[:20]+ '...'+ part_name[-20:]}.mp3"
+    else:
+        return f"{folder_book}/{part['albums'][0]['track_position']['index']} - {part_name}.mp3"
+
+
+def _book_tags(mp3, part, s, info_book, cover):
+    """Тэги и обложка части аудиокниги"""
+    mp3['tracktitle'] = part['title']
+    mp3['album'] = info_book['book_title']
+    mp3['discnumber'] = part['albums'][0]['track_position']['volume']
+    mp3['tracknumber'] = part['albums'][0]['track_position']['index']
+    mp3['totaltracks'] = info_book['parts']
+    mp3['genre'] = s['genre']
+    mp3['Year'] = s['year']
+    mp3['artist'] = info_book['artists']
+    mp3['album_artist'] = info_book['artists']
+    mp3['comment'] = info_book['description']
+    mp3['artwork'] = cover #ложим картинку в тег "artwork"
+
+
+@logger.catch
+def download_book(album_id):
+    """Скачиваем аудиокнигу"""
+    s = client.albumsWithTracks(album_id=album_id)
+    info_book, folder_book = _book_info(s)
+
+    author_echo = f"Author: {info_book['author']}"
+    logger.info(author_echo) # вывод в лог
+    book_echo = f"Book ID: {album_id} / Book title - {info_book['book_title']}"
+    logger.info(book_echo)  # вывод в лог
+
     os.makedirs(os.path.dirname(folder_book), exist_ok=True)
     file_cover = f"{folder_book}/cover.jpg"
-    with open(file_cover, 'wb') as f:
-        rec = requests.get(info_book['cover_url'])
-        f.write(rec.content)
+    cover = covers.save(s['cover_uri'], file_cover)
 
-    volumes = s['volumes']
-    for volume in volumes:
+    manifest = Manifest(folder_book)
+    jobs = []
+    for volume in s['volumes']:
         for part in volume:
-            # начинаем закачивать треки
-
-            track_info = client.tracks_download_info(track_id=part['id'], get_direct_links=True) # узнаем информацию о треке 
-            track_info.sort(reverse=True, key=lambda key: key['bitrate_in_kbps'])
-            part_download_link = track_info[0]['direct_link']
-            
-            part_echo = f"Start Download: ID: {part['id']} {part['title']} bitrate: {track_info[0]['bitrate_in_kbps']} {track_info[0]['direct_link']}"
-            logger.info(part_echo)  # вывод в лог
-            part_name = ''.join([ _ for _ in part['title'] if _ not in wrong_symbols])
-            if len(part['title']) > 50:
-                track_file = f"{folder_book}/{part['albums'][0]['track_position']['index']} - {part_name[:20]+ '...'+ part_name[-20:]}.mp3"
-            else:
-                track_file = f"{folder_book}/{part['albums'][0]['track_position']['index']} - {part_name}.mp3"
-            # проверяем существование трека на сервере
-            if os.path.exists(track_file):
-                track_echo_ok = "Track already exists. Continue."
-                logger.info(track_echo_ok)
-                continue
-            
-            with open(track_file, 'wb') as f:
-                rec = requests.get(part_download_link)
-                f.write(rec.content)
-            
-            track_echo_ok = "Track downloaded. Start write tag's."
-            logger.info(track_echo_ok)  # вывод в лог
-
-            #начинаем закачивать тэги в трек
-            mp3 = music_tag.load_file(track_file)
-            mp3['tracktitle'] = part['title']
-            mp3['album'] = info_book['book_title']
-            mp3['discnumber'] = part['albums'][0]['track_position']['volume']
-            mp3['tracknumber'] = part['albums'][0]['track_position']['index']
-            mp3['totaltracks'] = info_book['parts']
-            mp3['genre'] = s['genre']
-            mp3['Year'] = s['year']
-            mp3['artist'] = info_book['artists']
-            mp3['album_artist'] = info_book['artists']
-            mp3['comment'] = info_book['description']
-            with open(file_cover, 'rb') as img_in:   #ложим картинку в тег "artwork"
-                mp3['artwork'] = img_in.read()
-
-            mp3.save() # сохраняем тэги в mp3
-            tags_echo = "Tag's is writed"
-            logger.info(tags_echo)  # вывод в лог
-    return f"Успешно скачал аудиокнигу: {info_book['book_title']} из {info_book['parts']} частей"
+            track_file = _book_part_file(folder_book, part)
+            fill_tags = partial(_book_tags, part=part, s=s, info_book=info_book, cover=cover)
+            job = {'id': part['id'], 'title': part['title'], 'track_file': track_file, 'folder': folder_book,
+                   'manifest': manifest, 'fill_tags': fill_tags}
+            pipeline.submit(job)
+            jobs.append(job)
+    failed = _wait_jobs(jobs)[2]
+    library.scan(folder_book)
+    mess = f"Успешно скачал аудиокнигу: {info_book['book_title']} из {info_book['parts']} частей"
+    if failed:
+        mess += f"\nНе удалось скачать частей: {failed}. Посмотри log"
+    return mess
 
 
 @logger.catch
@@ -270,76 +760,130 @@ def get_podcast_info(podcast_id):
     return f"Подкаст:\n{podcast['title']}\nсодержание из {podcast['track_count']} выпусков."
 
 
-@logger.catch
-def download_podcast(podcast_id):
-    s = client.albumsWithTracks(album_id=podcast_id)
+def _podcast_info(s):
+    """Собираем тэги подкаста и путь к его папке"""
     info_podcast = {}
     info_podcast['title'] = s['title']
-    info_podcast['cover_url'] = 'https://' + s['cover_uri'].replace('%%', '1000x1000')
     info_podcast['tracks'] = s['track_count']
     info_podcast['short_description'] = s['short_description']
     info_podcast['description'] = s['description']
+    folder_podcast = f"{folder_podcasts}/{''.join([_ for _ in info_podcast['title'] if _ not in wrong_symbols])}/"
+    return info_podcast, folder_podcast
+
+
+def _podcast_part_file(folder_podcast, part):
+    """Путь к файлу выпуска подкаста"""
+    return f"{folder_podcast}/#{part['albums'][0]['track_position']['volume']}-{part['albums'][0]['track_position']['index']} - {''.join([_ for _ in part['title'] if _ not in wrong_symbols])}.mp3"
+
+
+def _podcast_tags(mp3, part, info_podcast, cover):
+    """Тэги и обложка выпуска подкаста"""
+    mp3['tracktitle'] = part['title']
+
+    mp3['discnumber'] = part['albums'][0]['track_position']['volume']
+    mp3['tracknumber'] = part['albums'][0]['track_position']['index']
+    mp3['totaltracks'] = info_podcast['tracks']
+    mp3['artist'] = info_podcast['title']
+    mp3['album_artist'] = info_podcast['title']
+    mp3['comment'] = part['short_description']
+
+    mp3['artwork'] = cover # ложим картинку в тег "artwork"
+
+
+@logger.catch
+def download_podcast(podcast_id):
+    return _download_podcast(podcast_id)[0]
+
+
+def _download_podcast(podcast_id, new_only=False):
+    """Качаем подкаст. Возвращает сообщение, сколько выпусков не скачалось и число выпусков подкаста.
+
+    new_only - только выпуски, которых нет в манифесте: список выпусков берётся свежий, мимо кэша,
+    а уже скачанные не проверяются на диске.
+    """
+    s = client.albumsWithTracks(album_id=podcast_id, fresh=new_only)
+    info_podcast, folder_podcast = _podcast_info(s)
 
     podcast_echo = f"Podcast ID: {podcast_id} / Podcast title - {info_podcast['title']}"
     logger.info(podcast_echo)  # вывод в лог
 
-    folder_podcast = f"{folder_podcasts}/{''.join([_ for _ in info_podcast['title'] if _ not in wrong_symbols])}/"
-
     os.makedirs(os.path.dirname(folder_podcast), exist_ok=True)
     file_cover = f"{folder_podcast}cover.jpg"
     file_description = f"{folder_podcast}info.txt"
 
-    with open(file_cover, 'wb') as f:
-        rec = requests.get(info_podcast['cover_url']) 
-        f.write(rec.content) # записываем картинку обложки
+    cover = covers.save(s['cover_uri'], file_cover) # записываем картинку обложки
 
     with open(file_description, 'w') as f:
         f.write(info_podcast['description']) 
 
-    volumes = s['volumes']
-    for volume in volumes:
+    manifest = Manifest(folder_podcast)
+    known = manifest.done_ids() if new_only else set()
+    jobs = []
+    for volume in s['volumes']:
         for part in volume:
-            # начинаем закачивать выпуски подкастов
-            track_info = client.tracks_download_info(track_id=part['id'],
-                                                     get_direct_links=True)  # узнаем информацию о выпуске
-            track_info.sort(reverse=True, key=lambda key: key['bitrate_in_kbps'])
-            part_download_link = track_info[0]['direct_link']
-
-            part_echo = f"Start Download: ID: {part['id']} {part['title']} bitrate: {track_info[0]['bitrate_in_kbps']} {track_info[0]['direct_link']}"
-            logger.info(part_echo)  # вывод в лог
-
-            track_file = f"{folder_podcast}/#{part['albums'][0]['track_position']['volume']}-{part['albums'][0]['track_position']['index']} - {''.join([_ for _ in part['title'] if _ not in wrong_symbols])}.mp3"
-            # проверяем существование трека на сервере
-            if os.path.exists(track_file):
-                track_echo_ok = "Track already exists. Continue."
-                logger.info(track_echo_ok)
+            if str(part['id']) in known:
                 continue
-            
-            with open(track_file, 'wb') as f:
-                rec = requests.get(part_download_link)
-                f.write(rec.content)
-
-            track_echo_ok = "Track downloaded. Start write tag's."
-            logger.info(track_echo_ok)  # вывод в лог
-
-            # начинаем закачивать тэги в трек
-            mp3 = music_tag.load_file(track_file)
-            mp3['tracktitle'] = part['title']
-
-            mp3['discnumber'] = part['albums'][0]['track_position']['volume']
-            mp3['tracknumber'] = part['albums'][0]['track_position']['index']
-            mp3['totaltracks'] = info_podcast['tracks']
-            mp3['artist'] = info_podcast['title']
-            mp3['album_artist'] = info_podcast['title']
-            mp3['comment'] = part['short_description']
-
-            with open(file_cover, 'rb') as img_in:  # ложим картинку в тег "artwork"
-                mp3['artwork'] = img_in.read()
-
-            mp3.save()  # сохраняем тэги в mp3
-            tags_echo = "Tag's is writed"
-            logger.info(tags_echo)  # вывод в лог
-    return f"Успешно скачал подкаст: {info_podcast['title']} из {info_podcast['tracks']} выпусков"
+            track_file = _podcast_part_file(folder_podcast, part)
+            fill_tags = partial(_podcast_tags, part=part, info_podcast=info_podcast, cover=cover)
+            job = {'id': part['id'], 'title': part['title'], 'track_file': track_file, 'folder': folder_podcast,
+                   'manifest': manifest, 'fill_tags': fill_tags}
+            pipeline.submit(job)
+            jobs.append(job)
+    failed = _wait_jobs(jobs)[2]
+    library.scan(folder_podcast)
+    if new_only:
+        mess = f"Подкаст {info_podcast['title']}: новых выпусков {len(jobs) - failed}"
+    else:
+        mess = f"Успешно скачал подкаст: {info_podcast['title']} из {info_podcast['tracks']} выпусков"
+    if failed:
+        mess += f"\nНе удалось скачать выпусков: {failed}. Посмотри log"
+    return mess, failed, s['track_count']
+
+
+@logger.catch
+def update_podcast(podcast_id):
+    """Докачиваем новые выпуски подкаста из подписки"""
+    mess, failed, track_count = _download_podcast(podcast_id, new_only=True)
+    # с ошибками число выпусков не запоминаем: при следующей проверке попробуем снова
+    subscriptions.checked(podcast_id, track_count=None if failed else track_count)
+    return mess
+
+
+def _is_podcast(album):
+    return 'podcast' in (album['meta_type'], album['type'])
+
+
+def subscribe_podcast(podcast_id, chat_id):
+    """Подписываем чат на подкаст. Возвращает название подкаста и новая ли это подписка.
+
+    None - если такого альбома нет, False - если это не подкаст (альбом или аудиокнига): на них не подписываем.
+    """
+    albums = client.albums([podcast_id])
+    if not albums:
+        return None
+    if not _is_podcast(albums[0]):
+        return False
+    return albums[0]['title'], subscriptions.add(podcast_id, chat_id, albums[0]['title'])
+
+
+def podcasts_with_new_episodes():
+    """Подкасты из подписок, у которых число выпусков выросло: {podcast_id: [chat_id]}.
+
+    Подкасты запрашиваются пачками по 100 и без списка выпусков, так что сотня подписок - один запрос.
+    """
+    podcasts = subscriptions.counts()
+    ids = list(podcasts)
+    changed = {}
+    for n in range(0, len(ids), 100):
+        for album in client.albums(ids[n:n + 100]):
+            podcast_id = str(album['id'])
+            track_count, chats = podcasts[podcast_id]
+            if (album['track_count'] or 0) != track_count:
+                changed[podcast_id] = chats
+            else:
+                subscriptions.checked(podcast_id, title=album['title'])
+    logger.info(f"Podcast subscriptions: {len(ids)}, with new episodes: {len(changed)}")
+    return changed
 
 
 type_to_name = {
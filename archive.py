@@ -0,0 +1,59 @@
+import io
+import os
+import zipfile
+
+# уже сжатое кладём в архив как есть: deflate тут только тратит время
+stored_ext = {'.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac', '.jpg', '.jpeg', '.png', '.zip'}
+zip_overhead = 128 # заголовки одного файла в zip без учёта имени (локальный + центральный каталог)
+
+
+def _folder_files(folder):
+    """Файлы папки со вложенными, кроме скрытых служебных: (путь, имя в архиве, размер)"""
+    base = os.path.dirname(os.path.abspath(folder))
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.'):
+                path = os.path.join(root, name)
+                yield path, os.path.relpath(path, base), os.path.getsize(path)
+
+
+def archive_parts(folder, part_size):
+    """Раскладываем файлы папки по частям архива, каждая меньше part_size байт.
+
+    Возвращает список частей (списки (путь, имя в архиве)) и файлы, которые больше part_size сами по себе.
+    """
+    parts, too_big, current, current_size = [], [], [], 22 # 22 - конец центрального каталога
+    for path, arcname, size in _folder_files(folder):
+        entry_size = size + zip_overhead + 2 * len(arcname.encode())
+        if entry_size + 22 > part_size:
+            too_big.append(path)
+            continue
+        if current and current_size + entry_size > part_size:
+            parts.append(current)
+            current, current_size = [], 22
+        current.append((path, arcname))
+        current_size += entry_size
+    if current:
+        parts.append(current)
+    return parts, too_big
+
+
+def build_part(files):
+    """Собираем часть архива в памяти, на диск библиотеки ничего не пишем: медиа без сжатия, текст со сжатием."""
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as zf:
+        for path, arcname in files:
+            if os.path.splitext(path)[1].lower() in stored_ext:
+                zf.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+            else:
+                zf.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED)
+    data.seek(0)
+    return data
+
+
+def part_name(folder, number, total):
+    name = os.path.basename(os.path.abspath(folder))
+    if total == 1:
+        return f"{name}.zip"
+    return f"{name} ({number} из {total}).zip"
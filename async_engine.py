@@ -0,0 +1,369 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from functools import partial
+import aiohttp
+from loguru import logger
+from yandex_music import ClientAsync
+from yandex_music.exceptions import NetworkError, NotFoundError, TimedOutError
+from yandex_music.utils.request_async import Request
+from yandex_music.utils.schema_mismatch import set_current_endpoint
+from API import (
+    _album_folder,
+    _album_message,
+    _album_stat,
+    _album_tags,
+    _album_track_info,
+    _artist_summary,
+    _book_info,
+    _book_part_file,
+    _book_tags,
+    _lyrics_tag,
+    _podcast_info,
+    _podcast_part_file,
+    _podcast_tags,
+    _write_lyrics_file,
+    lyrics_cache,
+    lyrics_threads,
+    album_threads,
+    covers,
+    library,
+)
+from manifest import Manifest
+from metrics import metrics
+from net import _part_file, api_limit, bandwidth, cdn_limit, chunk_size, timeout
+from tags import write_tags
+
+per_host_limit = int(os.getenv('ASYNC_PER_HOST', 8)) # сколько соединений одновременно держим к одному хосту
+track_limit = int(os.getenv('ASYNC_TRACKS', 16)) # сколько треков качаем одновременно (на все задачи сразу)
+
+
+class SessionRequestAsync(Request):
+    """Асинхронный Request для ClientAsync, который ходит через общую сессию движка вместо aiohttp.request."""
+
+    session = None
+
+    async def _request_wrapper(self, *args, **kwargs):
+        set_current_endpoint(*args[:2])
+        kwargs = self._prepare_kwargs(kwargs)
+        try:
+            attempt = 0
+            while True: # лимит и повторы на 429/5xx общие с синхронным движком (net.RateLimit)
+                await asyncio.sleep(api_limit.reserve())
+                async with self.session.request(*args, **kwargs) as resp:
+                    content = await resp.read()
+                if not api_limit.should_retry(resp.status, resp.headers.get('Retry-After'), attempt):
+                    break
+                attempt += 1
+        except asyncio.TimeoutError as e:
+            raise TimedOutError from e
+        except aiohttp.ClientError as e:
+            raise NetworkError(e) from e
+
+        if not 200 <= resp.status < 300:
+            self._handle_error_response(resp.status, content)
+        return content
+
+
+class AsyncEngine:
+    """Движок закачки на asyncio: те же папки, имена файлов и тэги, что у API.py, но без потока на каждый запрос.
+
+    Все задачи крутятся в одном цикле событий в отдельном потоке и делят одну aiohttp-сессию
+    с лимитом соединений на хост. Синхронный код (очередь бота) отдаёт ему корутины через run().
+    """
+
+    def __init__(self, token):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True).start()
+        self.run(self._start(token))
+
+    async def _start(self, token):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=per_host_limit)
+        self.session = aiohttp.ClientSession(connector=connector)
+        request = SessionRequestAsync()
+        request.session = self.session
+        self.client = await ClientAsync(token, base_url=os.getenv('YA_API_URL'), request=request).init()
+        self.tracks = asyncio.Semaphore(track_limit)
+        self.albums = asyncio.Semaphore(album_threads)
+        self.lyrics_limit = asyncio.Semaphore(lyrics_threads)
+        self.background = set() # фоновые задачи (тексты песен): держим ссылки, иначе их соберёт сборщик мусора
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def download_file(self, url, path):
+        """Асинхронный аналог net.download_file: .part, докачка через Range, атомарное переименование."""
+        part = _part_file(path)
+        done = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': f"bytes={done}-"} if done else {}
+        sha1 = hashlib.sha1()
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(cdn_limit.reserve())
+            rec = await self.session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(sock_read=timeout))
+            if not cdn_limit.should_retry(rec.status, rec.headers.get('Retry-After'), attempt):
+                break
+            rec.release()
+            attempt += 1
+        async with rec:
+            if rec.status == 416 and rec.headers.get('Content-Range') == f"bytes */{done}":
+                chunks, expected = None, done # .part уже докачан полностью, осталось переименовать
+            else:
+                rec.raise_for_status()
+                if rec.status != 206:
+                    done = 0 # сервер не умеет Range, качаем заново
+                if done:
+                    expected = int(rec.headers['Content-Range'].rsplit('/', 1)[1])
+                else:
+                    expected = int(rec.headers.get('Content-Length', 0))
+                chunks = rec.content.iter_chunked(chunk_size)
+            if done:
+                sha1 = await asyncio.to_thread(_hash_file, part)
+            with open(part, 'ab' if done else 'wb') as f:
+                if chunks is not None:
+                    async for chunk in chunks:
+                        delay = bandwidth.reserve(len(chunk))
+                        if delay:
+                            await asyncio.sleep(delay)
+                        metrics.downloaded(len(chunk))
+                        f.write(chunk)
+                        sha1.update(chunk)
+
+        size = os.path.getsize(part)
+        if expected and size != expected:
+            raise IOError(f"Incomplete download {path}: {size} of {expected} bytes")
+        os.replace(part, path)
+        return size, sha1.hexdigest()
+
+    async def best_download_info(self, track_id):
+        """Прямая ссылка только для лучшего битрейта, как API._best_download_info"""
+        track_info = await self.client.tracks_download_info(track_id=track_id)
+        track_info.sort(reverse=True, key=lambda key: key['bitrate_in_kbps'])
+        await track_info[0].get_direct_link_async()
+        return track_info[0]
+
+    async def fetch(self, track_id, track_file, folder, manifest, title):
+        """Качаем трек, если его ещё нет. Возвращает размер скачанного (0 - уже был) или None, если трек надо пропустить."""
+        if manifest.is_downloaded(track_id, track_file):
+            logger.info("Track already downloaded. Start write tag's.")
+            return 0
+        if os.path.exists(track_file) and not manifest.get(track_id): # скачан ещё до появления манифеста
+            logger.info("Track already exists. Continue.")
+            return None
+        track_info = await self.best_download_info(track_id)
+        logger.info(f"Start Download: ID: {track_id} {title} bitrate: {track_info['bitrate_in_kbps']} {track_info['direct_link']}")
+        size, sha1 = await self.download_file(track_info['direct_link'], track_file)
+        manifest.update(track_id, file=os.path.relpath(track_file, folder), size=size,
+                        bitrate=track_info['bitrate_in_kbps'], sha1=sha1, tagged=False)
+        logger.info("Track downloaded. Start write tag's.")
+        return size
+
+    async def download_track(self, track, tag_info, album, album_folder, album_cover, manifest):
+        async with self.tracks:
+            if manifest.is_done(track['id']):
+                logger.info("Track already exists. Continue.")
+                return 0
+            info, track_file = _album_track_info(track, tag_info, album, album_folder)
+            os.makedirs(os.path.dirname(track_file), exist_ok=True)
+            size = await self.fetch(track['id'], track_file, album_folder, manifest, track['title'])
+            if size is None:
+                return 0
+            lyrics = lyrics_cache.get(track['id']) # текст из кэша пишем сразу с тэгами, за остальными - в фоне
+            # music_tag переписывает файл целиком - это диск, а не сеть, уводим в поток
+            await asyncio.to_thread(write_tags, track_file, partial(_album_tags, info=info, album=album, tag_info=tag_info,
+                                                                    lyrics=lyrics, album_cover=album_cover))
+            manifest.update(track['id'], tagged=True, file_size=os.path.getsize(track_file))
+            logger.info("Tag's is writed")
+            if lyrics is None:
+                task = asyncio.create_task(self.track_lyrics(track['id'], track['title'], track_file, manifest))
+                self.background.add(task)
+                task.add_done_callback(self.background.discard)
+            else:
+                if lyrics:
+                    await asyncio.to_thread(_write_lyrics_file, track_file, lyrics)
+                manifest.update(track['id'], lyrics=bool(lyrics))
+            return size
+
+    async def track_lyrics(self, track_id, title, track_file, manifest):
+        """Фоновая задача, как стадия lyrics в API.py: текст в тэг lyrics и файлом рядом с треком"""
+        try:
+            async with self.lyrics_limit:
+                lyrics = await self.lyrics(track_id)
+            if lyrics is None:
+                return
+            if lyrics:
+                await asyncio.to_thread(_write_lyrics_file, track_file, lyrics)
+                await asyncio.to_thread(write_tags, track_file, partial(_lyrics_tag, lyrics=lyrics))
+            manifest.update(track_id, lyrics=bool(lyrics), file_size=os.path.getsize(track_file))
+        except Exception:
+            logger.exception(f"Lyrics of track ID: {track_id} {title} failed")
+
+    async def lyrics(self, track_id):
+        """Текст песни через общий с API.py кэш (там же отметка «текста нет»).
+
+        False - если текста нет, None - если узнать не удалось: такое не кэшируем, спросим в другой раз.
+        """
+        lyrics = lyrics_cache.get(track_id)
+        if lyrics is not None:
+            return lyrics
+        try:
+            lyrics = await (await self.client.tracks_lyrics(track_id=track_id)).fetch_lyrics_async()
+        except NotFoundError:
+            lyrics = False
+        except Exception:
+            logger.exception(f"Lyrics of track ID: {track_id} failed")
+            return None
+        lyrics_cache.put(track_id, lyrics)
+        return lyrics
+
+    async def download_album_stat(self, album_id):
+        async with self.albums:
+            album = await self.client.albums_with_tracks(album_id=album_id)
+            logger.info(f"Album ID: {album['id']} / Album title - {album['title']}")
+            album_folder, artist_folder = _album_folder(album)
+            if artist_folder:
+                artist = await self.client.artists_brief_info(artist_id=album['artists'][0]['id'])
+                os.makedirs(os.path.dirname(f"{artist_folder}/"), exist_ok=True)
+                await asyncio.to_thread(covers.save, artist['artist']['cover']['uri'], f"{artist_folder}/artist.jpg")
+            os.makedirs(os.path.dirname(f"{album_folder}/"), exist_ok=True)
+            album_cover = await asyncio.to_thread(covers.save, album['cover_uri'], f"{album_folder}/cover.jpg")
+
+            tracks = [track for disk in album['volumes'] for track in disk]
+            logger.info(f"Start download: Volumes: {len(album['volumes'])} / Tracks: {len(tracks)} / Async tracks: {track_limit}")
+            started = time.monotonic()
+            manifest = Manifest(album_folder)
+            tag_infos = {str(tag_info['id']): tag_info for tag_info in await self.client.tracks([track['id'] for track in tracks])}
+            results = await asyncio.gather(*[
+                self.download_track(track, tag_infos.get(str(track['id']), track), album, album_folder, album_cover, manifest)
+                for track in tracks
+            ], return_exceptions=True)
+
+            downloaded, skipped, failed, total_bytes = 0, 0, 0, 0
+            for track, result in zip(tracks, results):
+                if isinstance(result, Exception):
+                    logger.opt(exception=result).error(f"Track ID: {track['id']} {track['title']} failed")
+                    failed += 1
+                elif result:
+                    downloaded += 1
+                    total_bytes += result
+                else:
+                    skipped += 1
+            await asyncio.to_thread(library.scan, artist_folder or album_folder)
+            return _album_stat(album, downloaded, skipped, failed, total_bytes, time.monotonic() - started)
+
+    async def download_album(self, album_id):
+        return _album_message(await self.download_album_stat(album_id))
+
+    async def search_and_download_artist(self, search):
+        try:
+            search_result = await self.client.search(search, type_="artist", page=0, nocorrect=False)
+            artist = search_result['artists']['results'][0]
+        except Exception:
+            return f'Твой запрос: {search} не найден.'
+        albums_count = artist['counts']['direct_albums']
+        logger.info(f"Start download: Artist ID: {artist['id']} / Artist name: {artist['name']} / Direct albums: {albums_count}")
+        direkt_albums = await self.client.artists_direct_albums(artist_id=artist['id'], page_size=1000)
+        started = time.monotonic()
+        results = await asyncio.gather(*[self.download_album_stat(album['id']) for album in direkt_albums],
+                                       return_exceptions=True)
+        done, skipped, failed = [], [], []
+        for album, stat in zip(direkt_albums, results):
+            if isinstance(stat, Exception):
+                logger.opt(exception=stat).error(f"Album ID: {album['id']} {album['title']} failed")
+                failed.append(album['title'])
+            elif stat['failed']:
+                failed.append(stat['title'])
+            elif stat['downloaded']:
+                done.append(stat['title'])
+            else:
+                skipped.append(stat['title'])
+        return _artist_summary(artist['id'], artist['name'], albums_count, done, skipped, failed, time.monotonic() - started)
+
+    async def download_parts(self, s, folder, file_cover, part_file, fill_tags):
+        """Общая часть книг и подкастов: качаем все части параллельно и пишем в них тэги. Возвращает число ошибок."""
+        cover = await asyncio.to_thread(covers.save, s['cover_uri'], file_cover)
+        manifest = Manifest(folder)
+
+        async def download_part(part):
+            async with self.tracks:
+                track_file = part_file(folder, part)
+                if manifest.is_done(part['id']):
+                    logger.info("Track already exists. Continue.")
+                    return
+                if await self.fetch(part['id'], track_file, folder, manifest, part['title']) is None:
+                    return
+                await asyncio.to_thread(write_tags, track_file, partial(fill_tags, part=part, cover=cover))
+                manifest.update(part['id'], tagged=True, file_size=os.path.getsize(track_file))
+                logger.info("Tag's is writed")
+
+        parts = [part for volume in s['volumes'] for part in volume]
+        # как и в альбомах, ошибка одной части не должна обрывать остальные
+        results = await asyncio.gather(*[download_part(part) for part in parts], return_exceptions=True)
+        failed = 0
+        for part, result in zip(parts, results):
+            if isinstance(result, Exception):
+                logger.opt(exception=result).error(f"Track ID: {part['id']} {part['title']} failed")
+                failed += 1
+        await asyncio.to_thread(library.scan, folder)
+        return failed
+
+    async def download_book(self, album_id):
+        s = await self.client.albums_with_tracks(album_id=album_id)
+        info_book, folder_book = _book_info(s)
+        logger.info(f"Author: {info_book['author']}")
+        logger.info(f"Book ID: {album_id} / Book title - {info_book['book_title']}")
+        os.makedirs(os.path.dirname(folder_book), exist_ok=True)
+        failed = await self.download_parts(s, folder_book, f"{folder_book}/cover.jpg", _book_part_file,
+                                           lambda mp3, part, cover: _book_tags(mp3, part, s, info_book, cover))
+        mess = f"Успешно скачал аудиокнигу: {info_book['book_title']} из {info_book['parts']} частей"
+        if failed:
+            mess += f"\nНе удалось скачать частей: {failed}. Посмотри log"
+        return mess
+
+    async def download_podcast(self, podcast_id):
+        s = await self.client.albums_with_tracks(album_id=podcast_id)
+        info_podcast, folder_podcast = _podcast_info(s)
+        logger.info(f"Podcast ID: {podcast_id} / Podcast title - {info_podcast['title']}")
+        os.makedirs(os.path.dirname(folder_podcast), exist_ok=True)
+        with open(f"{folder_podcast}info.txt", 'w') as f:
+            f.write(info_podcast['description'])
+        failed = await self.download_parts(s, folder_podcast, f"{folder_podcast}cover.jpg", _podcast_part_file,
+                                           lambda mp3, part, cover: _podcast_tags(mp3, part, info_podcast, cover))
+        mess = f"Успешно скачал подкаст: {info_podcast['title']} из {info_podcast['tracks']} выпусков"
+        if failed:
+            mess += f"\nНе удалось скачать выпусков: {failed}. Посмотри log"
+        return mess
+
+
+def _hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1
+
+
+engine = AsyncEngine(os.getenv('YA_TOKEN'))
+
+
+@logger.catch
+def search_and_download_artist(search: str):
+    return engine.run(engine.search_and_download_artist(search))
+
+
+@logger.catch
+def download_album(album_id):
+    return engine.run(engine.download_album(album_id))
+
+
+@logger.catch
+def download_book(album_id):
+    return engine.run(engine.download_book(album_id))
+
+
+@logger.catch
+def download_podcast(podcast_id):
+    return engine.run(engine.download_podcast(podcast_id))
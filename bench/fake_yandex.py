@@ -0,0 +1,375 @@
+import argparse
+import json
+import random
+import re
+import struct
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ARTIST_ID = 1
+BOOK_ID = 2001
+PODCAST_ID = 3001
+
+# пара пустых MPEG-кадров (как tags._silent_mp3): mutagen без них mp3 не откроет
+_frame = (b'\xff\xfb\x90\x00' + bytes(413)) * 2
+
+
+def _segment(marker, payload):
+    return b'\xff' + bytes([marker]) + struct.pack('>H', len(payload) + 2) + payload
+
+
+def _jpeg(size):
+    """Настоящий JPEG 8x8 (серый квадрат) размером около size байт - Pillow должен его открыть.
+
+    Таблица квантования из единиц, в таблицах Хаффмана по одному коду: DC без разницы и конец блока.
+    До нужного размера добивается комментарием (COM).
+    """
+    head = (b'\xff\xd8'
+            + _segment(0xDB, b'\x00' + b'\x01' * 64)
+            + _segment(0xC0, b'\x08\x00\x08\x00\x08\x01\x01\x11\x00')
+            + _segment(0xC4, b'\x00\x01' + bytes(15) + b'\x00')
+            + _segment(0xC4, b'\x10\x01' + bytes(15) + b'\x00'))
+    scan = _segment(0xDA, b'\x01\x01\x00\x00\x3f\x00') + b'\x3f\xff\xd9'
+    padding = max(0, min(size - len(head) - len(scan) - 4, 0xFFFF - 2))
+    return head + _segment(0xFE, bytes(padding)) + scan
+
+
+class Catalog:
+    """Выдуманный каталог: артист с albums альбомами, аудиокнига из book_parts частей и подкаст из episodes выпусков.
+
+    Последние deluxe альбомов артиста - переиздания первых: их треки с теми же id плюс два бонусных,
+    как у настоящих делюкс-изданий, так что закачка артиста проходит и через dedup.
+    """
+
+    def __init__(self, albums=60, tracks_per_album=12, deluxe=6, book_parts=300, episodes=1000):
+        self.albums = {}
+        self.tracks = {}
+        self.artist_albums = []
+        next_track = iter(range(100000, 10 ** 9))
+        deluxe = min(deluxe, albums // 2)
+        for n in range(albums):
+            album_id = 1001 + n
+            if n >= albums - deluxe:
+                original = self.albums[1001 + n - (albums - deluxe)]
+                track_ids = original['track_ids'] + [next(next_track) for _ in range(2)]
+                title = original['title'] + ' Deluxe'
+            else:
+                track_ids = [next(next_track) for _ in range(tracks_per_album)]
+                title = f"Album {n + 1}"
+            self._album(album_id, title, 'music', track_ids, artist=True)
+            self.artist_albums.append(album_id)
+        self._album(BOOK_ID, 'Bench Author. Bench Book', 'audiobook', [next(next_track) for _ in range(book_parts)])
+        self._album(PODCAST_ID, 'Bench Podcast', 'podcast', [next(next_track) for _ in range(episodes)])
+
+    def _album(self, album_id, title, meta_type, track_ids, artist=False):
+        self.albums[album_id] = {'id': album_id, 'title': title, 'meta_type': meta_type, 'track_ids': track_ids,
+                                 'artist': artist}
+        for index, track_id in enumerate(track_ids, 1):
+            # трек переиздания остаётся за первым альбомом: у него и позиция, и название
+            self.tracks.setdefault(track_id, {'id': track_id, 'album_id': album_id, 'index': index,
+                                              'title': f"{'Part' if meta_type != 'music' else 'Track'} {index}"})
+
+
+class Options:
+    """Поведение сервера: задержки, пропускная способность и доля ошибок."""
+
+    def __init__(self, latency=0.0, cdn_latency=0.0, bandwidth=0, error_rate=0.0, error_status=503, seed=1,
+                 track_size=128 * 1024, lyrics_share=0.5):
+        self.latency = latency # секунд на ответ API
+        self.cdn_latency = cdn_latency # секунд до первого байта файла
+        self.bandwidth = bandwidth # байт/с на одно соединение с CDN, 0 - без лимита
+        self.error_rate = error_rate # доля ответов с ошибкой error_status
+        self.error_status = error_status
+        self.seed = seed
+        self.track_size = track_size
+        self.lyrics_share = lyrics_share # у какой доли треков есть текст
+
+
+class FakeYandex(ThreadingHTTPServer):
+    """HTTP-сервер, который отвечает как api.music.yandex.net, сервер download-info и CDN файлов и обложек.
+
+    Адреса CDN в ответах указывают на него же (https://host:port/...), бенчмарк переводит их на http.
+    /_stats - счётчики запросов по адресам, байты и ошибки; POST /_reset - обнулить их.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, catalog, options):
+        super().__init__(address, _Handler)
+        self.catalog = catalog
+        self.options = options
+        self.host = f"{self.server_address[0]}:{self.server_address[1]}"
+        self.audio = (_frame * (options.track_size // len(_frame) + 1))[:options.track_size]
+        self.cover = _jpeg(60 * 1024)
+        self.lock = threading.Lock()
+        self.attempts = Counter() # адрес -> сколько раз его запрашивали, для воспроизводимых ошибок
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter()
+            self.errors = Counter()
+            self.bytes_sent = 0
+            self.attempts.clear()
+
+    def count(self, endpoint, path):
+        """Считает запрос и решает, ответить ли на него ошибкой.
+
+        Решение зависит только от seed, адреса и номера попытки, а не от порядка потоков -
+        на одном и том же прогоне ошибки каждый раз приходятся на одни и те же запросы.
+        """
+        with self.lock:
+            self.requests[endpoint] += 1
+            attempt = self.attempts[path]
+            self.attempts[path] += 1
+        if self.options.error_rate and random.Random(f"{self.options.seed}|{path}|{attempt}").random() < self.options.error_rate:
+            with self.lock:
+                self.errors[endpoint] += 1
+            return True
+        return False
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_sent += size
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'errors': dict(self.errors), 'bytes_sent': self.bytes_sent}
+
+    # объекты в том виде, в каком их отдаёт API (camelCase)
+
+    def artist(self, artist_id):
+        return {'id': artist_id, 'name': 'Bench Artist', 'various': False, 'composer': False,
+                'cover': {'type': 'from-artist-photos', 'uri': f"{self.host}/cover/artist-{artist_id}/%%"},
+                'counts': {'tracks': sum(len(self.catalog.albums[a]['track_ids']) for a in self.catalog.artist_albums),
+                           'directAlbums': len(self.catalog.artist_albums), 'alsoAlbums': 0, 'alsoTracks': 0},
+                'genres': ['rock']}
+
+    def album(self, album_id, with_tracks=False):
+        album = self.catalog.albums[album_id]
+        meta_type = album['meta_type']
+        data = {'id': album_id, 'title': album['title'], 'metaType': meta_type,
+                'type': meta_type if meta_type != 'music' else None, 'year': 2000 + album_id % 20,
+                'releaseDate': f"{2000 + album_id % 20}-01-01T00:00:00+03:00", 'genre': 'rock',
+                'coverUri': f"{self.host}/cover/album-{album_id}/%%", 'trackCount': len(album['track_ids']),
+                'artists': [self.artist(ARTIST_ID) if album['artist'] else
+                            {'id': album_id, 'name': album['title'], 'various': False, 'composer': False}],
+                'labels': [{'id': 1, 'name': 'Bench Label'}], 'available': True,
+                'description': f"Описание {album['title']}", 'shortDescription': 'Коротко'}
+        if with_tracks:
+            data['volumes'] = [[self.track(track_id, album_id, index) for index, track_id in enumerate(album['track_ids'], 1)]]
+        return data
+
+    def track(self, track_id, album_id=None, index=None):
+        track = self.catalog.tracks[track_id]
+        album_id = album_id or track['album_id']
+        album = self.catalog.albums[album_id]
+        index = index or track['index']
+        return {'id': track_id, 'realId': str(track_id), 'title': track['title'], 'available': True,
+                'durationMs': 180000, 'artists': [{'id': ARTIST_ID, 'name': 'Bench Artist', 'various': False,
+                                                   'composer': False}],
+                'albums': [{'id': album_id, 'title': album['title'], 'genre': 'rock', 'year': 2000 + album_id % 20,
+                            'trackPosition': {'volume': 1, 'index': index}}],
+                'shortDescription': 'Выпуск', 'lyricsAvailable': self.has_lyrics(track_id)}
+
+    def has_lyrics(self, track_id):
+        return random.Random(f"{self.options.seed}|lyrics|{track_id}").random() < self.options.lyrics_share
+
+
+def _api_routes():
+    """(метод, регулярка пути, имя обработчика) - порядок важен"""
+    return [
+        ('GET', r'/account/status', 'account'),
+        ('GET', r'/search', 'search'),
+        ('GET', r'/artists/(\d+)/direct-albums', 'direct_albums'),
+        ('GET', r'/artists/(\d+)/brief-info', 'brief_info'),
+        ('GET', r'/albums/(\d+)/with-tracks', 'with_tracks'),
+        ('POST', r'/albums', 'albums'),
+        ('POST', r'/tracks', 'tracks'),
+        ('GET', r'/tracks/(\d+)/download-info', 'download_info'),
+        ('GET', r'/tracks/(\d+)/lyrics', 'lyrics'),
+        ('GET', r'/download-info/(\d+)', 'download_xml'),
+        ('GET', r'/lyrics-text/(\d+)', 'lyrics_text'),
+        ('GET', r'/get-mp3/[^/]+/[^/]+/audio/(\d+)', 'audio'),
+        ('GET', r'/cover/([^/]+)/[^/]+', 'cover'),
+    ]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, как у настоящего API: пул соединений клиента работает как в жизни
+    routes = [(method, re.compile(pattern + '$'), name) for method, pattern, name in _api_routes()]
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        self.form = parse_qs(self.rfile.read(length).decode()) if length else {}
+        self.query = parse_qs(url.query)
+        if url.path == '/_stats':
+            return self._json(self.server.stats(), wrap=False)
+        if url.path == '/_reset' and method == 'POST':
+            self.server.reset()
+            return self._json({}, wrap=False)
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                break
+        else:
+            return self._error(404, 'not-found')
+        cdn = name in ('audio', 'cover')
+        if self.server.count(name, self.path):
+            time.sleep(self.server.options.latency)
+            return self._error(self.server.options.error_status, 'injected')
+        time.sleep(self.server.options.cdn_latency if cdn else self.server.options.latency)
+        getattr(self, '_' + name)(*match.groups())
+
+    def _json(self, result, status=200, wrap=True):
+        body = json.dumps({'invocationInfo': {'hostname': 'bench', 'req-id': 'bench'}, 'result': result}
+                          if wrap else result).encode()
+        self._send(status, body, 'application/json')
+
+    def _error(self, status, name):
+        body = json.dumps({'error': {'name': name, 'message': name}}).encode()
+        self._send(status, body, 'application/json')
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.sent(len(body))
+
+    def _ids(self, name):
+        values = self.form.get(name, []) + self.query.get(name, [])
+        return [int(value) for item in values for value in item.split(',') if value.strip()]
+
+    def _account(self):
+        self._json({'account': {'uid': 1, 'login': 'bench', 'now': '2020-01-01T00:00:00+00:00', 'serviceAvailable': True},
+                    'permissions': {'until': '2099-01-01T00:00:00+00:00', 'values': [], 'default': []},
+                    'plus': {'hasPlus': True, 'isTutorialCompleted': True}})
+
+    def _search(self):
+        artist = self.server.artist(ARTIST_ID)
+        self._json({'searchRequestId': 'bench', 'text': self.query.get('text', [''])[0], 'misspellCorrected': False,
+                    'nocorrect': False, 'artists': {'total': 1, 'perPage': 10, 'order': 0, 'results': [artist]},
+                    'best': {'type': 'artist', 'result': artist}})
+
+    def _direct_albums(self, artist_id):
+        albums = [self.server.album(album_id) for album_id in self.server.catalog.artist_albums]
+        self._json({'albums': albums, 'pager': {'total': len(albums), 'page': 0, 'perPage': len(albums)}})
+
+    def _brief_info(self, artist_id):
+        self._json({'artist': self.server.artist(int(artist_id)), 'albums': [], 'alsoAlbums': [],
+                    'popularTracks': [], 'similarArtists': [], 'allCovers': [], 'concerts': [], 'videos': [],
+                    'vinyls': [], 'hasPromotions': False, 'lastReleases': [], 'lastReleaseIds': [], 'stats': {}, 'playlistIds': []})
+
+    def _with_tracks(self, album_id):
+        if int(album_id) not in self.server.catalog.albums:
+            return self._error(404, 'not-found')
+        self._json(self.server.album(int(album_id), with_tracks=True))
+
+    def _albums(self):
+        catalog = self.server.catalog
+        self._json([self.server.album(album_id) for album_id in self._ids('album-ids') if album_id in catalog.albums])
+
+    def _tracks(self):
+        catalog = self.server.catalog
+        self._json([self.server.track(track_id) for track_id in self._ids('track-ids') if track_id in catalog.tracks])
+
+    def _download_info(self, track_id):
+        host = self.server.host
+        self._json([{'codec': 'mp3', 'bitrateInKbps': bitrate, 'gain': False, 'preview': False, 'direct': False,
+                     'downloadInfoUrl': f"http://{host}/download-info/{track_id}?bitrate={bitrate}"}
+                    for bitrate in (128, 192, 320)])
+
+    def _download_xml(self, track_id):
+        body = (f"<?xml version=\"1.0\" encoding=\"utf-8\"?><download-info><host>{self.server.host}</host>"
+                f"<path>/audio/{track_id}</path><ts>0000</ts><region>-1</region><s>bench</s></download-info>").encode()
+        self._send(200, body, 'text/xml')
+
+    def _lyrics(self, track_id):
+        if not self.server.has_lyrics(int(track_id)):
+            return self._error(404, 'not-found')
+        self._json({'downloadUrl': f"http://{self.server.host}/lyrics-text/{track_id}", 'lyricId': int(track_id),
+                    'externalLyricId': str(track_id), 'writers': ['Bench Writer'],
+                    'major': {'id': 1, 'name': 'BENCH', 'prettyName': 'Bench'}})
+
+    def _lyrics_text(self, track_id):
+        self._send(200, f"Текст песни {track_id}\nла-ла-ла\n".encode(), 'text/plain; charset=utf-8')
+
+    def _audio(self, track_id):
+        self._media(self.server.audio, 'audio/mpeg')
+
+    def _cover(self, name):
+        self._media(self.server.cover, 'image/jpeg')
+
+    def _media(self, data, content_type):
+        """Файл с поддержкой Range и ограничением скорости на соединение"""
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                return self._send(416, b'', content_type, {'Content-Range': f"bytes */{len(data)}"})
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data) - start))
+        if start:
+            self.send_header('Content-Range', f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.end_headers()
+        bandwidth = self.server.options.bandwidth
+        chunk = max(4096, bandwidth // 20) if bandwidth else 64 * 1024
+        for offset in range(start, len(data), chunk):
+            piece = data[offset:offset + chunk]
+            self.wfile.write(piece)
+            if bandwidth:
+                time.sleep(len(piece) / bandwidth)
+        self.server.sent(len(data) - start)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=0, host='127.0.0.1', catalog=None, options=None):
+    """Сервер в отдельном потоке; адрес API - f'http://{server.host}'"""
+    server = FakeYandex((host, port), catalog or Catalog(), options or Options())
+    threading.Thread(target=server.serve_forever, name='fake-yandex', daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=0, help='задержка ответа API, мс')
+    parser.add_argument('--cdn-latency-ms', type=float, default=0, help='задержка до первого байта файла, мс')
+    parser.add_argument('--bandwidth-kb', type=int, default=0, help='скорость одного соединения с CDN, КБ/с (0 - без лимита)')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов с ошибкой, 0..1')
+    parser.add_argument('--error-status', type=int, default=503, help='код ответа с ошибкой (429, 500, 503...)')
+    parser.add_argument('--track-kb', type=int, default=128, help='размер одного трека, КБ')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def options_from_args(args):
+    return Options(latency=args.latency_ms / 1000, cdn_latency=args.cdn_latency_ms / 1000,
+                   bandwidth=args.bandwidth_kb * 1024, error_rate=args.error_rate, error_status=args.error_status,
+                   seed=args.seed, track_size=args.track_kb * 1024)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная замена API Яндекс Музыки и CDN для бенчмарков')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--host', default='127.0.0.1')
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = FakeYandex((args.host, args.port), Catalog(), options_from_args(args))
+    print(f"YA_API_URL=http://{server.host}", flush=True)
+    server.serve_forever()
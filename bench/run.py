@@ -0,0 +1,254 @@
+"""Бенчмарк закачки и браузера /files без Яндекса и Telegram.
+
+    python -m bench.run                              # все сценарии
+    python -m bench.run artist podcast --scale 0.1   # выборочно и уменьшенные
+    python -m bench.run --latency-ms 50 --bandwidth-kb 2048 --error-rate 0.02 --out new.json --compare old.json
+
+Сценарии: artist (60 альбомов, 6 из них - переиздания), audiobook (300 частей), podcast (1000 выпусков)
+и browse (100 тыс. файлов в /files). Закачки идут в bench/fake_yandex.py; каждый сценарий - отдельный процесс
+со своей временной папкой, так что пиковая память (RSS) - только его. Фазы: cold - с нуля, warm - повторно,
+когда всё уже скачано. Настройки закачки (DOWNLOAD_THREADS, TAG_IN_MEMORY, DEDUP...) берутся из окружения.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+from bench import fake_yandex
+
+scenarios = ['artist', 'audiobook', 'podcast', 'browse']
+sizes = {'artist': 60, 'audiobook': 300, 'podcast': 1000, 'browse': 100000}
+
+
+def _sizes(scale):
+    return {name: max(2, round(size * scale)) for name, size in sizes.items()}
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+def _server_stats(api_url):
+    return requests.get(f"{api_url}/_stats", timeout=10).json()
+
+
+def _delta(before, after):
+    """Запросы, ошибки и байты сервера за фазу"""
+    requests_count = {name: count - before['requests'].get(name, 0) for name, count in after['requests'].items()}
+    errors = {name: count - before['errors'].get(name, 0) for name, count in after['errors'].items()}
+    return {'requests': {name: count for name, count in requests_count.items() if count},
+            'errors': {name: count for name, count in errors.items() if count},
+            'bytes': after['bytes_sent'] - before['bytes_sent']}
+
+
+def _count_files(folder, ext='.mp3'):
+    return sum(name.endswith(ext) for _, _, files in os.walk(folder) for name in files)
+
+
+def _download_scenario(name, api_url, folder):
+    """Закачка через API.py: фазы cold и warm, запросы по данным сервера"""
+    os.environ.update({
+        'YA_TOKEN': 'bench', 'YA_API_URL': api_url,
+        'DOWNLOAD_PATH_MUSIC': f"{folder}/music", 'DOWNLOAD_PATH_BOOKS': f"{folder}/books",
+        'DOWNLOAD_PATH_PODCASTS': f"{folder}/podcasts",
+    })
+    # всё служебное - во временную папку, даже если в .env указано другое
+    for key in ('META_CACHE_DB', 'COVER_CACHE_DIR', 'LIBRARY_DB', 'TRACK_STORE_DB', 'LYRICS_DB', 'SUBSCRIPTIONS_DB',
+                'DOWNLOAD_PATH_PLAYLISTS'):
+        os.environ.pop(key, None)
+    # лимиты Яндекса к локальному серверу не нужны, если их не задали явно
+    os.environ.setdefault('API_RATE', '0')
+    os.environ.setdefault('CDN_RATE', '0')
+    for path in ('music', 'books', 'podcasts'):
+        os.makedirs(f"{folder}/{path}", exist_ok=True)
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level=os.getenv('BENCH_LOG_LEVEL', 'WARNING'))
+    started = time.monotonic()
+    import API
+    import net
+    from requests.adapters import HTTPAdapter
+    import_seconds = time.monotonic() - started
+
+    class PlainAdapter(HTTPAdapter):
+        """Файлы и обложки Яндекс отдаёт по https, локальный сервер - по http"""
+
+        def send(self, request, **kwargs):
+            request.url = 'http' + request.url[len('https'):]
+            return super().send(request, **kwargs)
+
+    host = api_url.split('://', 1)[1]
+    net.session.mount(f"https://{host}", PlainAdapter(pool_connections=net.pool_size, pool_maxsize=net.pool_size))
+
+    run = {
+        'artist': lambda: API.search_and_download_artist('Bench Artist'),
+        'audiobook': lambda: API.download_book(fake_yandex.BOOK_ID),
+        'podcast': lambda: API.download_podcast(fake_yandex.PODCAST_ID),
+    }[name]
+    rerun = {'podcast': lambda: API.update_podcast(fake_yandex.PODCAST_ID)}.get(name, run)
+    phases = {}
+    for phase, func in (('cold', run), ('warm', rerun)):
+        before = _server_stats(api_url)
+        started = time.monotonic()
+        message = func()
+        API.pipeline.join('lyrics') # тексты песен качаются в фоне - ждём и их
+        seconds = time.monotonic() - started
+        stat = _delta(before, _server_stats(api_url))
+        phases[phase] = dict(stat, seconds=round(seconds, 3), items=stat['requests'].get('audio', 0), unit='треков',
+                             files=_count_files(folder), message=(message or 'failed').split('\n')[0])
+    return {'import_seconds': round(import_seconds, 3), 'phases': phases,
+            'pipeline': API.pipeline.stats(), 'covers': API.covers.stats()}
+
+
+def _browse_scenario(files, folder):
+    """Браузер /files на files файлах: первый индекс, листание всех папок по страницам, повторный проход"""
+    from library import Library
+    from sessions import Session
+    root = f"{folder}/music"
+    artists = max(1, round(files ** 0.5 / 3))
+    albums = max(1, round(files ** 0.5 / 15))
+    per_album = max(1, files // (artists * albums))
+    started = time.monotonic()
+    for artist in range(artists):
+        for album in range(albums):
+            album_folder = f"{root}/Artist {artist:03}/Album {album:02} (2000)/Disk 1"
+            os.makedirs(album_folder)
+            for track in range(per_album):
+                open(f"{album_folder}/{track + 1} - Track {track + 1}.mp3", 'wb').close()
+    create_seconds = time.monotonic() - started
+
+    library = Library(f"{folder}/library.db")
+    phases = {}
+    started = time.monotonic()
+    library.scan(root)
+    phases['index'] = {'seconds': round(time.monotonic() - started, 3), 'items': artists * albums * per_album, 'unit': 'файлов'}
+
+    def browse():
+        """Как пользователь: открываем каждую папку и листаем её по 15 кнопок"""
+        session, pages, stack = Session(root), 0, [root]
+        while stack:
+            session.open(stack.pop())
+            library.refresh(session.cur_dir)
+            session.listing = library.list(session.cur_dir, limit=-1)
+            for session.start_window in range(0, len(session.listing), 15):
+                window = session.listing[session.start_window:session.start_window + 15]
+                stack.extend(library.get(entry_id)[0] for entry_id, _, is_dir in window if is_dir)
+                pages += 1
+        return pages
+
+    for phase in ('cold', 'warm'):
+        started = time.monotonic()
+        pages = browse()
+        phases[phase] = {'seconds': round(time.monotonic() - started, 3), 'items': pages, 'unit': 'страниц'}
+    return {'create_seconds': round(create_seconds, 3), 'phases': phases}
+
+
+def child(name, api_url, scale, keep):
+    """Один сценарий в своём процессе; результат - JSON последней строкой stdout"""
+    folder = tempfile.mkdtemp(prefix=f"ymd-bench-{name}-")
+    try:
+        if name == 'browse':
+            result = _browse_scenario(_sizes(scale)['browse'], folder)
+        else:
+            result = _download_scenario(name, api_url, folder)
+    finally:
+        if not keep:
+            shutil.rmtree(folder, ignore_errors=True)
+    result.update(scenario=name, peak_rss_mb=_peak_rss_mb())
+    print(json.dumps(result, ensure_ascii=False), flush=True)
+
+
+def _report(results, previous=None):
+    """Таблица по фазам; с previous - изменение времени, запросов и памяти к прошлому прогону"""
+    previous = {result['scenario']: result for result in (previous or {}).get('results', [])}
+    rows = [('сценарий', 'фаза', 'сек', 'сделано', 'в сек', 'МБ/с', 'запросов', 'ошибок', 'RSS МБ')]
+    for result in results:
+        for phase, stat in result['phases'].items():
+            total = sum(stat.get('requests', {}).values())
+            row = [result['scenario'], phase, f"{stat['seconds']:.2f}", f"{stat['items']} {stat['unit']}",
+                   f"{stat['items'] / stat['seconds']:.1f}" if stat['seconds'] else '-',
+                   f"{stat['bytes'] / 1024 / 1024 / stat['seconds']:.1f}" if stat.get('bytes') else '-',
+                   str(total) if 'requests' in stat else '-',
+                   str(sum(stat['errors'].values())) if 'errors' in stat else '-',
+                   str(result['peak_rss_mb'])]
+            old = previous.get(result['scenario'], {}).get('phases', {}).get(phase)
+            if old:
+                row[2] += f" ({_change(stat['seconds'], old['seconds'])})"
+                if 'requests' in stat:
+                    row[6] += f" ({_change(total, sum(old['requests'].values()))})"
+                if phase == next(iter(result['phases'])):
+                    row[8] += f" ({_change(result['peak_rss_mb'], previous[result['scenario']]['peak_rss_mb'])})"
+            rows.append(row)
+    widths = [max(len(row[n]) for row in rows) for n in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+    for result in results:
+        for phase, stat in result['phases'].items():
+            if stat.get('requests'):
+                print(f"{result['scenario']}/{phase}: " + ', '.join(f"{name} {count}" for name, count in sorted(stat['requests'].items())))
+
+
+def _change(new, old):
+    if not old or new is None:
+        return '-'
+    return f"{(new - old) * 100 / old:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк закачки и браузера /files на локальном сервере')
+    parser.add_argument('scenarios', nargs='*', help=f"сценарии: {', '.join(scenarios)} (по умолчанию все)")
+    parser.add_argument('--scale', type=float, default=1.0, help='размер сценариев относительно полного (0.1 - в 10 раз меньше)')
+    parser.add_argument('--out', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--keep', action='store_true', help='не удалять временные папки')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--api', help=argparse.SUPPRESS)
+    fake_yandex.add_arguments(parser)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.api, args.scale, args.keep)
+    unknown = set(args.scenarios) - set(scenarios)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    size = _sizes(args.scale)
+    catalog = fake_yandex.Catalog(albums=size['artist'], book_parts=size['audiobook'], episodes=size['podcast'])
+    server = fake_yandex.serve(catalog=catalog, options=fake_yandex.options_from_args(args))
+    api_url = f"http://{server.host}"
+    results = []
+    for name in args.scenarios or scenarios:
+        server.reset()
+        command = [sys.executable, '-m', 'bench.run', '--child', name, '--api', api_url, '--scale', str(args.scale)]
+        if args.keep:
+            command.append('--keep')
+        print(f"{name}...", file=sys.stderr, flush=True)
+        done = subprocess.run(command, stdout=subprocess.PIPE, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        if done.returncode:
+            print(f"{name}: процесс завершился с кодом {done.returncode}", file=sys.stderr)
+            continue
+        results.append(json.loads(done.stdout.strip().splitlines()[-1]))
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='UTF8') as f:
+            previous = json.load(f)
+    _report(results, previous)
+    if args.out:
+        settings = {key: value for key, value in os.environ.items()
+                    if key.endswith(('_THREADS', '_RATE', '_QUEUE', '_KB')) or key in ('TAG_IN_MEMORY', 'DEDUP', 'HTTP_POOL_SIZE')}
+        with open(args.out, 'w', encoding='UTF8') as f:
+            json.dump({'args': vars(args), 'settings': settings, 'results': results}, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import deque
+from loguru import logger
+from metrics import metrics
+
+
+class ChatPool:
+    """Пул потоков для апдейтов бота: задачи одного чата идут строго по порядку, разные чаты - параллельно.
+
+    Медленный ответ API в одном чате занимает один поток, а не весь бот.
+    Задержка ответа считается от получения апдейта до конца его обработки.
+    """
+
+    def __init__(self, workers, max_pending=1000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.queues = {} # chat_id -> задачи чата по порядку
+        self.ready = deque() # чаты, у которых есть задачи и сейчас ничего не выполняется
+        self.running = set()
+        self.pending = 0
+        self.processed = 0
+        self.wait_time = 0
+        self.latencies = deque(maxlen=1000) # последние задержки для p95
+        self.max_latency = 0
+        for n in range(workers):
+            threading.Thread(target=self._work, name=f"bot-{n}", daemon=True).start()
+
+    def submit(self, chat_id, func, *args):
+        """Ставит задачу чата в очередь. При max_pending задач в очереди ждёт - опрос Telegram притормозит."""
+        with self.cond:
+            while self.pending >= self.max_pending:
+                self.cond.wait()
+            chat_queue = self.queues.setdefault(chat_id, deque())
+            chat_queue.append((func, args, time.monotonic()))
+            self.pending += 1
+            if chat_id not in self.running and len(chat_queue) == 1:
+                self.ready.append(chat_id)
+                self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                chat_id = self.ready.popleft()
+                func, args, submitted = self.queues[chat_id].popleft()
+                self.running.add(chat_id)
+            started = time.monotonic()
+            try:
+                func(*args)
+            except Exception as e:
+                metrics.error('bot', e)
+                logger.exception(f"Update of chat {chat_id} failed")
+            finished = time.monotonic()
+            metrics.observe('bot_update_seconds', finished - submitted)
+            with self.cond:
+                self.running.discard(chat_id)
+                self.pending -= 1
+                if self.queues[chat_id]:
+                    self.ready.append(chat_id)
+                else:
+                    del self.queues[chat_id]
+                self.processed += 1
+                self.wait_time += started - submitted
+                self.latencies.append(finished - submitted)
+                self.max_latency = max(self.max_latency, finished - submitted)
+                self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'processed': self.processed,
+                'avg_wait': round(self.wait_time / self.processed, 3) if self.processed else 0,
+                'avg_latency': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+                'p95_latency': round(latencies[int(len(latencies) * 0.95)], 3) if latencies else 0,
+                'max_latency': round(self.max_latency, 3),
+            }
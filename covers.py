@@ -0,0 +1,92 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from metrics import metrics
+from net import download_file
+
+
+class CoverCache:
+    """Кэш обложек по cover_uri и размеру: файлы на диске плюс ограниченный LRU в памяти.
+
+    Одну и ту же обложку (например артиста на каждом его альбоме) качаем из сети один раз.
+    """
+
+    def __init__(self, folder, max_items=64, stripes=64):
+        self.folder = folder
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # замки по ключу полосами: память постоянная, а разные обложки в одну полосу попадают редко
+        self.key_locks = [threading.Lock() for _ in range(stripes)]
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, cover_uri, size='1000x1000'):
+        """Возвращает байты обложки: из памяти, с диска или, если её ещё нет, из сети."""
+        key = hashlib.sha1(f"{cover_uri}|{size}".encode()).hexdigest()
+        key_lock = self.key_locks[int(key[:8], 16) % len(self.key_locks)]
+        # одну обложку одновременно качает только один поток, остальные дождутся её в кэше
+        with key_lock:
+            data = self._memory_get(key)
+            if data is not None:
+                self._count(True, len(data))
+                return data
+            cache_file = os.path.join(self.folder, f"{key}.jpg")
+            if os.path.exists(cache_file):
+                with open(cache_file, 'rb') as f:
+                    data = f.read()
+                self._count(True, len(data))
+            else:
+                with metrics.timer('stage_seconds', stage='cover'):
+                    download_file('https://' + cover_uri.replace('%%', size), cache_file, resume=False)
+                with open(cache_file, 'rb') as f:
+                    data = f.read()
+                self._count(False)
+            self._memory_put(key, data)
+            return data
+
+    def save(self, cover_uri, path, size='1000x1000'):
+        """Кладёт обложку в path (cover.jpg, artist.jpg), если там ещё нет такого же файла. Возвращает её байты."""
+        data = self.get(cover_uri, size)
+        if not os.path.exists(path) or os.path.getsize(path) != len(data):
+            folder, name = os.path.split(path)
+            tmp_path = os.path.join(folder, f".{name}.{threading.get_ident()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return data
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0,
+                'bytes_saved': self.bytes_saved,
+            }
+
+    def _count(self, hit, size=0):
+        with self.lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+            else:
+                self.misses += 1
+
+    def _memory_get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+            return data
+
+    def _memory_put(self, key, data):
+        with self.lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
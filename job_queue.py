@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+import time
+
+
+class JobQueue:
+    """Очередь закачек в файле SQLite: переживает перезапуск, раздаёт задачи нескольким потокам.
+
+    Задачи одного чата выполняются строго по очереди, разные чаты качаются параллельно.
+    Выполненные задачи хранятся keep_days дней (для разбора, что и когда качалось), потом удаляются.
+    """
+
+    def __init__(self, path, keep_days=7):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.keep = keep_days * 86400
+        self.cond = threading.Condition()
+        with self.cond:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                arg TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                result TEXT
+            )""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            # задачи, прерванные перезапуском, возвращаем в очередь
+            self.db.execute("UPDATE jobs SET status = 'pending', started = NULL WHERE status = 'running'")
+            self._prune()
+            self.db.commit()
+
+    def put(self, kind, arg, chat_id):
+        """Добавляет задачу и будит свободный поток. Возвращает количество задач в очереди."""
+        with self.cond:
+            self.db.execute("INSERT INTO jobs (kind, arg, chat_id, created) VALUES (?, ?, ?, ?)",
+                            (kind, str(arg), chat_id, time.time()))
+            self.db.commit()
+            self.cond.notify()
+            return self._count()
+
+    def put_many(self, jobs, chat_id):
+        """Добавляет пачку задач [(kind, arg)] одной транзакцией, пропуская те, что уже ждут или качаются.
+
+        Возвращает, сколько добавлено и сколько задач теперь в очереди.
+        """
+        with self.cond:
+            added = 0
+            for kind, arg in jobs:
+                if self.db.execute("SELECT 1 FROM jobs WHERE kind = ? AND arg = ? AND status IN ('pending', 'running')",
+                                   (kind, str(arg))).fetchone():
+                    continue
+                self.db.execute("INSERT INTO jobs (kind, arg, chat_id, created) VALUES (?, ?, ?, ?)",
+                                (kind, str(arg), chat_id, time.time()))
+                added += 1
+            self.db.commit()
+            self.cond.notify_all()
+            return added, self._count()
+
+    def get(self):
+        """Ждёт и забирает самую старую задачу чата, у которого сейчас ничего не качается."""
+        with self.cond:
+            while True:
+                row = self.db.execute("""SELECT id, kind, arg, chat_id FROM jobs
+                    WHERE status = 'pending'
+                    AND chat_id NOT IN (SELECT chat_id FROM jobs WHERE status = 'running')
+                    ORDER BY id LIMIT 1""").fetchone()
+                if row:
+                    self.db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                                    (time.time(), row[0]))
+                    self.db.commit()
+                    return row
+                self.cond.wait()
+
+    def done(self, job_id, result, ok=True):
+        """Отмечает задачу выполненной и будит потоки: у чата могла освободиться следующая задача."""
+        with self.cond:
+            self.db.execute("UPDATE jobs SET status = ?, finished = ?, result = ? WHERE id = ?",
+                            ('done' if ok else 'failed', time.time(), result, job_id))
+            self._prune()
+            self.db.commit()
+            self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return self._count()
+
+    def _prune(self):
+        """Удаляет выполненные задачи старше keep_days: иначе ночная синхронизация растила бы таблицу бесконечно"""
+        self.db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (time.time() - self.keep,))
+
+    def _count(self):
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]
@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import threading
+
+
+class Library:
+    """Индекс медиатеки в SQLite для браузера /files.
+
+    У каждого файла и папки свой постоянный id - он и уходит в callback_data кнопки.
+    Папка перечитывается с диска, только если изменилось её mtime, так что листание страниц
+    стоит одного stat вместо listdir и isdir/isfile по каждому файлу.
+    Скрытые служебные файлы и папки (манифест закачки, недокачанные .part, кэш обложек) в индекс не попадают.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL UNIQUE,
+                parent TEXT,
+                name TEXT NOT NULL,
+                is_dir INTEGER NOT NULL,
+                listed INTEGER
+            )""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent, is_dir, name)")
+            self.db.commit()
+
+    def refresh(self, folder):
+        """Перечитывает папку, если она изменилась с прошлого раза. Возвращает True, если перечитали."""
+        folder = os.path.abspath(folder)
+        mtime = os.stat(folder).st_mtime_ns
+        with self.lock:
+            row = self.db.execute("SELECT listed FROM entries WHERE path = ?", (folder,)).fetchone()
+        if row and row[0] == mtime:
+            return False
+        with os.scandir(folder) as it:
+            entries = [(entry.path, folder, entry.name, entry.is_dir()) for entry in it if not entry.name.startswith('.')]
+        with self.lock:
+            self.db.execute("""INSERT INTO entries (path, parent, name, is_dir, listed) VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT (path) DO UPDATE SET listed = excluded.listed""",
+                            (folder, os.path.dirname(folder), os.path.basename(folder), mtime))
+            # удалённое с диска убираем из индекса вместе со всем содержимым
+            known = {path for (path,) in self.db.execute("SELECT path FROM entries WHERE parent = ?", (folder,))}
+            for path in known - {entry[0] for entry in entries}:
+                self.db.execute("DELETE FROM entries WHERE path = ? OR substr(path, 1, ?) = ?",
+                                (path, len(path) + 1, path + os.sep))
+            # id существующих записей не меняется: upsert, а не REPLACE
+            self.db.executemany("""INSERT INTO entries (path, parent, name, is_dir) VALUES (?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET is_dir = excluded.is_dir""", entries)
+            self.db.commit()
+        return True
+
+    def scan(self, folder):
+        """Обновляет индекс всего дерева под folder (например, только что скачанного альбома)."""
+        stack = [os.path.abspath(folder)]
+        while stack:
+            path = stack.pop()
+            self.refresh(path)
+            with self.lock:
+                stack.extend(sub for (sub,) in self.db.execute(
+                    "SELECT path FROM entries WHERE parent = ? AND is_dir = 1", (path,)))
+
+    def list(self, folder, offset=0, limit=15):
+        """Страница содержимого папки: сначала папки, потом файлы, по имени. Список (id, name, is_dir)."""
+        with self.lock:
+            return self.db.execute("""SELECT id, name, is_dir FROM entries WHERE parent = ?
+                ORDER BY is_dir DESC, name LIMIT ? OFFSET ?""", (os.path.abspath(folder), limit, offset)).fetchall()
+
+    def count(self, folder):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries WHERE parent = ?",
+                                   (os.path.abspath(folder),)).fetchone()[0]
+
+    def has(self, path):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM entries WHERE path = ?", (os.path.abspath(path),)).fetchone() is not None
+
+    def get(self, entry_id):
+        """Путь и признак папки по id кнопки, None - если такой записи уже нет."""
+        with self.lock:
+            return self.db.execute("SELECT path, is_dir FROM entries WHERE id = ?", (entry_id,)).fetchone()
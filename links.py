@@ -0,0 +1,50 @@
+import re
+
+# ссылки music.yandex.ru/.com/.by/.kz/...: трек альбома, альбом (книги и подкасты - тоже альбомы), трек, плейлист
+link_re = re.compile(r"music\.yandex\.[a-z.]+/(?:"
+                     r"album/(?P<track_album>\d+)/track/(?P<album_track>\d+)"
+                     r"|album/(?P<album>\d+)"
+                     r"|track/(?P<track>\d+)"
+                     r"|users/(?P<owner>[^/\s?#]+)/playlists/(?P<kind>\d+)"
+                     r"|users/(?P<likes_owner>[^/\s?#]+)/tracks"
+                     r"|playlists/(?P<uuid>[\w.-]+))")
+
+
+def parse_links(text):
+    """Все ссылки Яндекс Музыки в тексте по порядку и без повторов: список (тип, id).
+
+    Тип - album, track или playlist. id плейлиста - owner:kind, uuid из новых ссылок или owner:likes («Мне нравится»).
+    """
+    links, seen = [], set()
+    for match in link_re.finditer(text):
+        if match['album_track']:
+            link = ('track', match['album_track'])
+        elif match['album']:
+            link = ('album', match['album'])
+        elif match['track']:
+            link = ('track', match['track'])
+        elif match['kind']:
+            link = ('playlist', f"{match['owner']}:{match['kind']}")
+        elif match['likes_owner']:
+            link = ('playlist', f"{match['likes_owner']}:likes")
+        else:
+            link = ('playlist', match['uuid'])
+        if link not in seen:
+            seen.add(link)
+            links.append(link)
+    return links
+
+
+def link_id(text, kind='album'):
+    """id первой ссылки нужного типа (альбом - и из ссылки на трек альбома).
+
+    Все цифры сообщения, как раньше, - только если ссылок в нём нет совсем, иначе '' - нужной ссылки нет.
+    """
+    for match in link_re.finditer(text):
+        if kind == 'album' and (match['album'] or match['track_album']):
+            return match['album'] or match['track_album']
+    links = parse_links(text)
+    for link_kind, item_id in links:
+        if link_kind == kind:
+            return item_id
+    return '' if links else ''.join([x for x in text if x.isdigit()])
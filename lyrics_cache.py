@@ -0,0 +1,44 @@
+import sqlite3
+import threading
+import time
+
+
+class LyricsCache:
+    """Тексты песен по id трека в SQLite, в том числе отметка «текста нет».
+
+    Отметка «нет» живёт negative_ttl секунд: у трека текст может появиться позже.
+    """
+
+    def __init__(self, path, negative_ttl=30 * 86400):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS lyrics (
+                track_id TEXT PRIMARY KEY,
+                text TEXT,
+                fetched REAL NOT NULL
+            )""")
+            self.db.commit()
+
+    def get(self, track_id):
+        """Текст, False - если текста нет, None - если в кэше ничего (или отметка «нет» устарела)."""
+        with self.lock:
+            row = self.db.execute("SELECT text, fetched FROM lyrics WHERE track_id = ?", (str(track_id),)).fetchone()
+            if row is None or (row[0] is None and time.time() - row[1] > self.negative_ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0] if row[0] is not None else False
+
+    def put(self, track_id, text):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO lyrics (track_id, text, fetched) VALUES (?, ?, ?)",
+                            (str(track_id), text or None, time.time()))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,59 @@
+import json
+import os
+import threading
+
+
+class Manifest:
+    """Манифест закачки альбома/книги/подкаста: .manifest.json в папке релиза.
+
+    По каждому треку хранит имя файла, ожидаемый размер, битрейт, sha1 скачанного звука
+    и записаны ли тэги, чтобы повторный запуск не качал и не перетэгивал готовые треки.
+    """
+
+    file_name = '.manifest.json'
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, self.file_name)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, encoding='UTF8') as f:
+                self.tracks = json.load(f)
+        except (OSError, ValueError):
+            self.tracks = {}
+
+    def get(self, track_id):
+        with self.lock:
+            return dict(self.tracks.get(str(track_id), {}))
+
+    def update(self, track_id, **fields):
+        """Обновляет запись трека и атомарно перезаписывает манифест."""
+        with self.lock:
+            self.tracks.setdefault(str(track_id), {}).update(fields)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='UTF8') as f:
+                json.dump(self.tracks, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def is_done(self, track_id):
+        """Трек скачан полностью и с тэгами: файл на месте и его размер совпадает с записанным."""
+        entry = self.get(track_id)
+        if not entry.get('tagged'):
+            return False
+        track_file = os.path.join(self.folder, entry['file'])
+        return os.path.exists(track_file) and os.path.getsize(track_file) == entry.get('file_size')
+
+    def is_downloaded(self, track_id, track_file):
+        """Звук скачан (файл уже переименован из временного), но тэги могли не записаться."""
+        entry = self.get(track_id)
+        return bool(entry.get('sha1')) and os.path.exists(track_file)
+
+    def done_ids(self):
+        """id треков, скачанных по манифесту полностью и с тэгами (без проверки файлов на диске)."""
+        with self.lock:
+            return {track_id for track_id, entry in self.tracks.items() if entry.get('tagged')}
+
+    def done_count(self):
+        """Сколько треков по манифесту скачано и с тэгами (без проверки файлов на диске)."""
+        with self.lock:
+            return sum(1 for entry in self.tracks.values() if entry.get('tagged'))
@@ -0,0 +1,110 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from yandex_music import Album, BriefInfo, Track
+
+
+class CachedClient:
+    """Обёртка над yandex_music.Client с кэшем альбомов, треков и артистов.
+
+    Кэш в памяти ограничен по размеру (LRU) и по времени жизни записи (ttl, сек.),
+    при заданном db_path записи дополнительно сохраняются в SQLite и переживают перезапуск.
+    Все остальные методы клиента проксируются как есть.
+    """
+
+    kinds = {'album': Album, 'track': Track, 'artist': BriefInfo}
+
+    def __init__(self, client, ttl=3600, max_items=5000, db_path=None):
+        self.client = client
+        self.ttl = ttl
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data TEXT NOT NULL, stored REAL NOT NULL)")
+            self.db.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def albums_with_tracks(self, album_id, *args, fresh=False, **kwargs):
+        """fresh=True - мимо кэша, например за новыми выпусками подкаста; кэш при этом обновляется."""
+        album = None if fresh else self._get('album', album_id)
+        if album is None:
+            album = self.client.albums_with_tracks(album_id, *args, **kwargs)
+            self._put('album', album_id, album)
+            # треки альбома приходят целиком, поэтому tracks() по ним в сеть уже не пойдёт
+            for volume in album.volumes or []:
+                for track in volume:
+                    self._put('track', track.id, track)
+        return album
+
+    def tracks(self, track_ids, *args, **kwargs):
+        """Как Client.tracks, но в сеть одним запросом уходят только id, которых нет в кэше."""
+        single = not isinstance(track_ids, (list, tuple))
+        ids = [str(track_id) for track_id in ([track_ids] if single else track_ids)]
+        found = {track_id: self._get('track', track_id) for track_id in ids}
+        missing = [track_id for track_id, track in found.items() if track is None]
+        if missing:
+            for track in self.client.tracks(missing, *args, **kwargs):
+                self._put('track', track.id, track)
+                found[str(track.id)] = track
+        return [found[track_id] for track_id in ids if found.get(track_id) is not None]
+
+    def artists_brief_info(self, artist_id, *args, **kwargs):
+        artist = self._get('artist', artist_id)
+        if artist is None:
+            artist = self.client.artists_brief_info(artist_id, *args, **kwargs)
+            self._put('artist', artist_id, artist)
+        return artist
+
+    albumsWithTracks = albums_with_tracks
+    artistsBriefInfo = artists_brief_info
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0,
+                'size': len(self.memory),
+            }
+
+    def _get(self, kind, obj_id):
+        key = f"{kind}:{obj_id}"
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute("SELECT data, stored FROM meta WHERE key = ?", (key,)).fetchone()
+                if row:
+                    entry = (self.kinds[kind].de_json(json.loads(row[0]), self.client), row[1])
+                    self.memory[key] = entry
+            if entry is None or now - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, kind, obj_id, obj):
+        if obj is None:
+            return
+        key = f"{kind}:{obj_id}"
+        now = time.time()
+        with self.lock:
+            self.memory[key] = (obj, now)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO meta (key, data, stored) VALUES (?, ?, ?)",
+                                (key, json.dumps(obj.to_dict(), ensure_ascii=False), now))
+                self.db.commit()
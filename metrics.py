@@ -0,0 +1,229 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Metrics:
+    """Счётчики, таймеры и датчики закачки в одном месте.
+
+    Отдаются текстом в формате Prometheus (serve) и сводкой для команды бота /stats.
+    Метки - именованные аргументы: inc('api_calls_total', endpoint='/tracks').
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float) # (имя, метки) -> значение
+        self.timers = {} # (имя, метки) -> [количество, сумма, максимум]
+        self.gauges = {} # имя -> (функция, имя метки)
+        self.seconds = defaultdict(float) # секунда -> скачано байт, для скорости за последнюю минуту
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def error(self, where, error):
+        """Ошибка по месту и типу исключения."""
+        self.inc('errors_total', where=where, error=type(error).__name__)
+
+    def downloaded(self, size):
+        """Байты, скачанные с CDN: общий счётчик и скорость за последнюю минуту."""
+        now = int(time.monotonic())
+        with self.lock:
+            self.counters[('download_bytes_total', ())] += size
+            self.seconds[now] += size
+            if len(self.seconds) > 120:
+                for second in [s for s in self.seconds if s < now - 60]:
+                    del self.seconds[second]
+
+    def speed(self, window=60):
+        """Скорость закачки в байт/с за последние window секунд."""
+        now = int(time.monotonic())
+        with self.lock:
+            return sum(size for second, size in self.seconds.items() if second >= now - window) / window
+
+    def gauge(self, name, func, label=None):
+        """Датчик, значение которого читается в момент запроса: func() -> число или {значение метки label: число}."""
+        self.gauges[name] = (func, label)
+
+    def render(self):
+        """Все метрики текстом в формате Prometheus."""
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {key: list(value) for key, value in self.timers.items()}
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+        for (name, labels), (count, total, longest) in sorted(timers.items()):
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_max{_labels(labels)} {longest:.6f}")
+        lines.append(f"download_bytes_per_second {self.speed():.0f}")
+        for name, (func, label) in sorted(self.gauges.items()):
+            try:
+                values = func()
+            except Exception:
+                continue
+            if label is None:
+                lines.append(f"{name} {values:g}")
+                continue
+            for label_value, value in values.items():
+                lines.append(f"{name}{_labels(((label, label_value),))} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Коротко для бота: скорость, вызовы API, время по стадиям и ошибки по типам."""
+        with self.lock:
+            timers = {key: list(value) for key, value in self.timers.items()}
+            counters = dict(self.counters)
+        stages = [f"{dict(labels)['stage']}: {count} шт., сред. {total / count:.2f} с, макс. {longest:.2f} с"
+                  for (name, labels), (count, total, longest) in sorted(timers.items()) if name == 'stage_seconds']
+        api_calls = sum(value for (name, _), value in counters.items() if name == 'api_calls_total')
+        errors = Counter()
+        for (name, labels), value in counters.items():
+            if name == 'errors_total':
+                errors[dict(labels)['error']] += value
+        mess = f"Скорость закачки: {self.speed() / 1024 / 1024:.2f} МБ/с за минуту, всего {counters.get(('download_bytes_total', ()), 0) / 1024 / 1024:.0f} МБ"
+        mess += f"\nЗапросов к API: {api_calls:g}"
+        if stages:
+            mess += '\n' + '\n'.join(stages)
+        if errors:
+            mess += '\nОшибки: ' + ', '.join(f"{error} {count:g}" for error, count in errors.most_common())
+        return mess
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in labels) + '}'
+
+
+def endpoint(url):
+    """Путь запроса к API без id, чтобы у метрики было немного разных значений: /albums/123/with-tracks -> /albums/:id/with-tracks"""
+    return re.sub(r'/[^/]*\d[^/]*', '/:id', urlparse(url).path)
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер: раз в interval секунд смотрит, где стоит каждый поток, и считает места.
+
+    Включается и выключается на ходу; накладные расходы только пока включён.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = Counter()
+        self.total = 0
+        self.thread = None
+        self.stopping = threading.Event() # у каждого потока замеров своё: выключенный поток не оживёт от start()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive() and not self.stopping.is_set()
+
+    def start(self):
+        # проверка и запуск под одним замком: два start() подряд не запустят два потока замеров
+        with self.lock:
+            if self.running:
+                return
+            self.stopping = threading.Event()
+            self.samples.clear()
+            self.total = 0
+            self.thread = threading.Thread(target=self._sample, args=(self.stopping,), name='profiler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopping.set()
+
+    def _sample(self, stopping):
+        me = threading.get_ident()
+        while not stopping.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or (frame.f_code.co_name == 'wait' and frame.f_code.co_filename.endswith('threading.py')):
+                    continue # сам профайлер и простаивающие потоки
+                # место в нашем коде: верхний кадр из файлов проекта, а не из библиотек
+                place = None
+                while frame is not None:
+                    code = frame.f_code
+                    if os.path.dirname(os.path.abspath(code.co_filename)) == _here:
+                        place = f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+                        break
+                    frame = frame.f_back
+                if place:
+                    with self.lock:
+                        if stopping.is_set():
+                            return # замеры уже выключены или начаты заново другим потоком
+                        self.samples[place] += 1
+                        self.total += 1
+            stopping.wait(self.interval)
+
+    def top(self, limit=20):
+        """Самые частые места: строки «процент место»."""
+        with self.lock:
+            total = self.total or 1
+            return [f"{count * 100 / total:5.1f}% {place}" for place, count in self.samples.most_common(limit)]
+
+
+_here = os.path.dirname(os.path.abspath(__file__))
+metrics = Metrics()
+profiler = SamplingProfiler(float(os.getenv('PROFILE_INTERVAL_MS', 10)) / 1000)
+if os.getenv('PROFILE', '0') == '1':
+    profiler.start()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """/metrics - метрики Prometheus, /profile - профайлер (?on=1 / ?on=0 - включить / выключить)."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            body = metrics.render()
+        elif url.path == '/profile':
+            on = parse_qs(url.query).get('on')
+            if on and on[0] == '1':
+                profiler.start()
+            elif on:
+                profiler.stop()
+            body = f"running: {profiler.running}, samples: {profiler.total}\n" + '\n'.join(profiler.top(50)) + '\n'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    """HTTP-сервер метрик в отдельном потоке."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
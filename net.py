@@ -0,0 +1,272 @@
+import hashlib
+import itertools
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import endpoint, metrics
+from yandex_music.exceptions import NetworkError, TimedOutError
+from yandex_music.utils.request import Request
+from yandex_music.utils.schema_mismatch import set_current_endpoint
+
+chunk_size = int(os.getenv('DOWNLOAD_CHUNK_KB', 64)) * 1024 # сколько байт пишем на диск за раз
+speed_limit = int(os.getenv('DOWNLOAD_SPEED_LIMIT_KB', 0)) * 1024 # общий лимит скорости закачки в байт/с, 0 - без лимита
+timeout = 30
+pool_size = int(os.getenv('HTTP_POOL_SIZE', 16)) # сколько соединений держим открытыми на каждый хост
+retries = int(os.getenv('HTTP_RETRIES', 3)) # сколько раз повторять запрос после 429/5xx
+
+
+class BandwidthLimit:
+    """Общий на все потоки лимит скорости: каждый кусок занимает своё окно времени в расписании."""
+
+    def __init__(self, bytes_per_sec):
+        self.rate = bytes_per_sec
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def reserve(self, size):
+        """Занимает окно под size байт и возвращает, сколько секунд надо подождать перед записью."""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now) + size / self.rate
+            return self.next_time - now
+
+    def consume(self, size):
+        delay = self.reserve(size)
+        if delay:
+            time.sleep(delay)
+
+
+bandwidth = BandwidthLimit(speed_limit)
+
+
+class RateLimit:
+    """Общий на все потоки token bucket для одной группы запросов (API метаданных или CDN) с адаптивным темпом.
+
+    Запросы идут не чаще rate в секунду, до burst подряд без ожидания; rate=0 - без лимита.
+    На 429/5xx темп падает вдвое и все потоки ждут паузу (Retry-After или нарастающую),
+    после каждого успешного ответа темп понемногу возвращается к rate.
+    """
+
+    def __init__(self, name, rate, burst=None):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.lock = threading.Lock()
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.recent = deque() # время последних запросов - для текущей скорости
+        self.requests = 0
+        self.throttled = 0
+        self.retried = 0
+        self.waited = 0
+
+    def reserve(self):
+        """Занимает место под запрос и возвращает, сколько секунд надо подождать перед ним."""
+        with self.lock:
+            now = time.monotonic()
+            self.requests += 1
+            self.recent.append(now)
+            while self.recent[0] < now - 10:
+                self.recent.popleft()
+            delay = 0
+            if self.max_rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+                self.updated = now
+                delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            delay = max(delay, self.paused_until - now)
+            self.waited += delay
+            return delay
+
+    def wait(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def should_retry(self, status, retry_after, attempt):
+        """Учитывает ответ: на 429/5xx тормозит всех и говорит, повторять ли запрос."""
+        with self.lock:
+            if status != 429 and status < 500:
+                if self.rate < self.max_rate:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                return False
+            self.throttled += 1
+            if self.max_rate:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+            pause = float(retry_after) if retry_after and retry_after.isdigit() else 0.5 * 2 ** attempt
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            if attempt >= retries:
+                return False
+            self.retried += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limit': self.max_rate,
+                'rate': round(self.rate, 2),
+                'actual': round(len(self.recent) / 10, 2),
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'retried': self.retried,
+                'waited': round(self.waited, 1),
+            }
+
+
+api_limit = RateLimit('api', float(os.getenv('API_RATE', 10))) # запросов в секунду к API метаданных
+cdn_limit = RateLimit('cdn', float(os.getenv('CDN_RATE', 20))) # запросов в секунду к серверам с файлами
+metrics.gauge('rate_limit', lambda: {limit.name: limit.rate for limit in (api_limit, cdn_limit)}, label='group')
+
+
+def limits_stats():
+    return {'api': api_limit.stats(), 'cdn': cdn_limit.stats()}
+
+
+def _make_session():
+    """Общая сессия requests: keep-alive, пул соединений и повторы при обрыве соединения.
+
+    Повторы на 429/5xx делает limited_request, чтобы их видел и учитывал RateLimit.
+    """
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(), respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+session = _make_session()
+
+
+def session_stats():
+    """Сколько запросов прошло через пул и сколько из них переиспользовали уже открытое соединение."""
+    requests_count, connections = 0, 0
+    for adapter in {id(a): a for a in session.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections += pool.num_connections
+    return {'requests': requests_count, 'connections': connections, 'reused': requests_count - connections}
+
+
+def limited_request(limit, method, url, **kwargs):
+    """Запрос через общую сессию с учётом лимита limit и повторами на 429/5xx."""
+    attempt = 0
+    while True:
+        limit.wait()
+        resp = session.request(method, url, **kwargs)
+        metrics.inc('http_responses_total', group=limit.name, status=resp.status_code)
+        if not limit.should_retry(resp.status_code, resp.headers.get('Retry-After'), attempt):
+            return resp
+        resp.close()
+        attempt += 1
+
+
+class SessionRequest(Request):
+    """Request для yandex_music.Client, который ходит в сеть через общую сессию вместо requests.request."""
+
+    def _request_wrapper(self, *args, **kwargs):
+        set_current_endpoint(*args[:2])
+        kwargs = self._prepare_kwargs(kwargs)
+        metrics.inc('api_calls_total', endpoint=endpoint(args[1]))
+        try:
+            with metrics.timer('api_call_seconds', endpoint=endpoint(args[1])):
+                resp = limited_request(api_limit, *args, **kwargs)
+        except requests.Timeout as e:
+            raise TimedOutError from e
+        except requests.RequestException as e:
+            raise NetworkError(e) from e
+
+        if not 200 <= resp.status_code < 300:
+            self._handle_error_response(resp.status_code, resp.content)
+        return resp.content
+
+
+def _part_file(path):
+    """Временный файл закачки: скрытый, рядом с итоговым, чтобы переименование было атомарным."""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f".{name}.part")
+
+
+def download_file(url, path, resume=True, header=b''):
+    """Качаем файл потоком кусками по chunk_size во временный .part и переименовываем в path только целиком.
+
+    Если от прошлого запуска остался .part, докачиваем его запросом Range.
+    resume=False - для мелких файлов вроде обложек: временный файл уникальный, чтобы несколько потоков
+    могли одновременно качать один и тот же path.
+    header - готовый тэг (tags.id3_block), который ложится в начало файла перед звуком той же записью.
+    Если звук с сервера сам начинается с ID3, header не пишем - проверить можно через tags.starts_with.
+    Возвращает размер скачанного звука и sha1 его содержимого (без header).
+    """
+    if resume:
+        part = _part_file(path)
+        done = os.path.getsize(part) if os.path.exists(part) else 0
+    else:
+        fd, part = tempfile.mkstemp(prefix='.', suffix='.part', dir=os.path.dirname(path))
+        os.close(fd)
+        done = 0
+    try:
+        size, digest = _fetch_part(url, part, done, header)
+    except BaseException:
+        if not resume:
+            os.remove(part)
+        raise
+    os.replace(part, path)
+    return size, digest
+
+
+def _fetch_part(url, part, done, header=b''):
+    """Дописываем в part звук начиная с байта done и проверяем, что файл докачан целиком."""
+    sha1 = hashlib.sha1()
+    offset = 0 # сколько байт в начале part занимает header
+    if done and header:
+        with open(part, 'rb') as f:
+            offset = len(header) if f.read(len(header)) == header else 0
+        done = done - offset if offset else 0 # .part без нашего тэга качаем заново
+    headers = {'Range': f"bytes={done}-"} if done else {}
+
+    with limited_request(cdn_limit, 'GET', url, headers=headers, stream=True, timeout=timeout) as rec:
+        if rec.status_code == 416 and rec.headers.get('Content-Range') == f"bytes */{done}":
+            rec_iter, expected = [], done # .part уже докачан полностью, осталось переименовать
+        else:
+            rec.raise_for_status()
+            if rec.status_code != 206:
+                done = 0 # сервер не умеет Range, качаем заново
+            if done:
+                expected = int(rec.headers['Content-Range'].rsplit('/', 1)[1])
+            else:
+                expected = int(rec.headers.get('Content-Length', 0))
+            rec_iter = rec.iter_content(chunk_size)
+        if done:
+            with open(part, 'rb') as f:
+                f.seek(offset)
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    sha1.update(chunk)
+        elif header:
+            first = next(rec_iter, b'')
+            rec_iter = itertools.chain([first], rec_iter)
+            offset = 0 if first.startswith(b'ID3') else len(header) # свой тэг у звука уже есть - оставляем его
+        with open(part, 'ab' if done else 'wb') as f:
+            if not done and offset:
+                f.write(header)
+            for chunk in rec_iter:
+                bandwidth.consume(len(chunk))
+                metrics.downloaded(len(chunk))
+                f.write(chunk)
+                sha1.update(chunk)
+
+    size = os.path.getsize(part) - offset
+    if expected and size != expected:
+        raise IOError(f"Incomplete download {part}: {size} of {expected} bytes")
+    return size, sha1.hexdigest()
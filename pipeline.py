@@ -0,0 +1,97 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from metrics import metrics
+
+
+class Stage:
+    """Стадия конвейера: свой пул потоков и ограниченная очередь на входе.
+
+    func(job) делает свою часть работы и возвращает имя следующей стадии или None, если задача готова.
+    """
+
+    def __init__(self, pipeline, name, func, workers, maxsize):
+        self.pipeline = pipeline
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.wait_time = 0
+        self.work_time = 0
+        for n in range(workers):
+            threading.Thread(target=self._work, name=f"{name}-{n}", daemon=True).start()
+
+    def put(self, job):
+        job['queued'] = time.monotonic()
+        self.queue.put(job) # при полной очереди ждём: предыдущая стадия не убежит вперёд
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            started = time.monotonic()
+            try:
+                next_stage = self.func(job)
+            except Exception as e:
+                metrics.error(self.name, e)
+                self._count(job, started, failed=True)
+                job['future'].set_exception(e)
+                self.queue.task_done()
+                continue
+            self._count(job, started)
+            if next_stage:
+                self.pipeline.stages[next_stage].put(job)
+            else:
+                job['future'].set_result(job.get('result', 0))
+            self.queue.task_done()
+
+    def _count(self, job, started, failed=False):
+        metrics.observe('stage_seconds', time.monotonic() - started, stage=self.name)
+        with self.lock:
+            self.processed += 1
+            self.failed += failed
+            self.wait_time += started - job['queued']
+            self.work_time += time.monotonic() - started
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'queue': self.queue.qsize(),
+                'processed': self.processed,
+                'failed': self.failed,
+                'avg_wait': round(self.wait_time / self.processed, 3) if self.processed else 0,
+                'avg_latency': round(self.work_time / self.processed, 3) if self.processed else 0,
+            }
+
+
+class Pipeline:
+    """Конвейер из стадий с отдельными пулами: сеть и диск работают одновременно, а не по очереди в одном потоке.
+
+    По avg_wait и размеру очереди стадии видно, что тормозит: сеть (resolve/download) или диск (tag).
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.first = None
+
+    def add_stage(self, name, func, workers, maxsize):
+        self.stages[name] = Stage(self, name, func, workers, maxsize)
+        if self.first is None:
+            self.first = name
+
+    def submit(self, job, stage=None):
+        """Отправляет задачу (dict) в конвейер. Результат - Future со значением job['result']."""
+        job['future'] = Future()
+        self.stages[stage or self.first].put(job)
+        return job['future']
+
+    def join(self, stage):
+        """Ждёт, пока стадия доделает всё, что ей отдали (например, фоновые тексты песен после закачки)."""
+        self.stages[stage].queue.join()
+
+    def stats(self):
+        return {name: stage.stats() for name, stage in self.stages.items()}
@@ -0,0 +1,37 @@
+import json
+import os
+import re
+
+
+class PlaylistState:
+    """Состояние синхронизации плейлиста: .state/<id>.json в папке плейлистов.
+
+    Хранит ревизию, на которой плейлист синхронизировали в прошлый раз, имя его M3U
+    и файл каждого трека (путь относительно папки плейлистов), чтобы следующая синхронизация
+    качала только добавленные треки.
+    """
+
+    def __init__(self, folder, playlist_id):
+        self.folder = folder
+        self.path = os.path.join(folder, '.state', re.sub(r'[^\w.-]', '_', playlist_id) + '.json')
+        try:
+            with open(self.path, encoding='UTF8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        self.revision = state.get('revision')
+        self.m3u = state.get('m3u')
+        self.files = state.get('files', {}) # track_id -> путь к файлу
+
+    def has(self, track_id):
+        """Трек уже синхронизирован и его файл на месте."""
+        path = self.files.get(str(track_id))
+        return bool(path) and os.path.exists(os.path.join(self.folder, path))
+
+    def save(self):
+        """Атомарно перезаписывает состояние."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF8') as f:
+            json.dump({'revision': self.revision, 'm3u': self.m3u, 'files': self.files}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
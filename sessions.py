@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Session:
+    """Состояние браузера /files одного чата."""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.cur_dir = root_dir
+        self.start_window = 0
+        self.listing = None # содержимое cur_dir [(id, name, is_dir)], None - надо перечитать
+
+    def open(self, folder, root_dir=None):
+        """Переходим в папку: страницу и закэшированный список сбрасываем."""
+        if root_dir is not None:
+            self.root_dir = root_dir
+        self.cur_dir = folder
+        self.start_window = 0
+        self.listing = None
+
+
+class SessionStore:
+    """Сессии чатов в памяти: ограниченный LRU, сессия без действий дольше ttl секунд забывается.
+
+    У каждого чата своя папка и своя страница, поэтому одновременные пользователи друг другу не мешают.
+    """
+
+    def __init__(self, root_dir, max_items=1000, ttl=3600):
+        self.root_dir = root_dir
+        self.max_items = max_items
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, chat_id):
+        """Сессия чата: существующая или новая в корне музыки."""
+        now = time.monotonic()
+        with self.lock:
+            # в начале OrderedDict самые давно тронутые сессии
+            while self.sessions and now - next(iter(self.sessions.values()))[1] > self.ttl:
+                self.sessions.popitem(last=False)
+            entry = self.sessions.pop(chat_id, None)
+            session = entry[0] if entry else Session(self.root_dir)
+            self.sessions[chat_id] = (session, now)
+            while len(self.sessions) > self.max_items:
+                self.sessions.popitem(last=False)
+            return session
+
+    def pop(self, chat_id):
+        with self.lock:
+            self.sessions.pop(chat_id, None)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
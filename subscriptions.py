@@ -0,0 +1,65 @@
+import sqlite3
+import threading
+import time
+
+
+class Subscriptions:
+    """Подписки чатов на подкасты в SQLite.
+
+    По каждому подкасту хранится число выпусков на момент последней закачки - по нему
+    дешёвая проверка (альбомы без треков, пачкой) решает, есть ли новые выпуски.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS subscriptions (
+                podcast_id TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                title TEXT,
+                track_count INTEGER NOT NULL DEFAULT 0,
+                checked REAL,
+                PRIMARY KEY (podcast_id, chat_id)
+            )""")
+            self.db.commit()
+
+    def add(self, podcast_id, chat_id, title):
+        """Подписывает чат. Возвращает False, если подписка уже была."""
+        with self.lock:
+            cursor = self.db.execute("INSERT OR IGNORE INTO subscriptions (podcast_id, chat_id, title) VALUES (?, ?, ?)",
+                                     (str(podcast_id), chat_id, title))
+            self.db.commit()
+            return cursor.rowcount > 0
+
+    def remove(self, podcast_id, chat_id):
+        with self.lock:
+            cursor = self.db.execute("DELETE FROM subscriptions WHERE podcast_id = ? AND chat_id = ?",
+                                     (str(podcast_id), chat_id))
+            self.db.commit()
+            return cursor.rowcount > 0
+
+    def list(self, chat_id):
+        """Подписки чата: список (podcast_id, title, track_count)."""
+        with self.lock:
+            return self.db.execute("SELECT podcast_id, title, track_count FROM subscriptions WHERE chat_id = ? ORDER BY title",
+                                   (chat_id,)).fetchall()
+
+    def counts(self):
+        """Сохранённое число выпусков и подписанные чаты каждого подкаста: {podcast_id: (track_count, [chat_id])}."""
+        podcasts = {}
+        with self.lock:
+            for podcast_id, chat_id, track_count in self.db.execute(
+                    "SELECT podcast_id, chat_id, track_count FROM subscriptions ORDER BY podcast_id"):
+                count, chats = podcasts.get(podcast_id, (track_count, []))
+                chats.append(chat_id)
+                podcasts[podcast_id] = (min(count, track_count), chats)
+        return podcasts
+
+    def checked(self, podcast_id, title=None, track_count=None):
+        """Отмечает проверку подкаста, а после успешной закачки - и новое число выпусков."""
+        with self.lock:
+            self.db.execute("""UPDATE subscriptions SET checked = ?, title = COALESCE(?, title),
+                track_count = COALESCE(?, track_count) WHERE podcast_id = ?""",
+                            (time.time(), title, track_count, str(podcast_id)))
+            self.db.commit()
@@ -0,0 +1,35 @@
+import io
+import os
+import music_tag
+from mutagen.mp3 import MP3
+
+# пара пустых MPEG-кадров (128 кбит/с, 44.1 кГц): mutagen без звука mp3 не откроет, а тэгам он не мешает
+_silent_mp3 = (b'\xff\xfb\x90\x00' + bytes(413)) * 2
+
+
+def write_tags(track_file, fill):
+    """Пишем тэги в уже скачанный файл: fill(mp3) делает присваивания mp3[...], затем файл перезаписывается."""
+    mp3 = music_tag.load_file(track_file)
+    fill(mp3)
+    mp3.save()
+
+
+def id3_block(fill):
+    """Собираем в памяти ID3v2 тэг целиком (с обложкой и текстом песни) теми же присваиваниями mp3[...].
+
+    Этот блок пишется в файл перед звуком, и файл ложится на диск одной последовательной записью.
+    """
+    mfile = MP3(io.BytesIO(_silent_mp3))
+    mfile.add_tags()
+    fill(music_tag.load_file(mfile))
+    block = io.BytesIO()
+    mfile.tags.save(block)
+    return block.getvalue()
+
+
+def starts_with(path, block):
+    """Файл начинается с нашего тэга - значит, он уже записан вместе со звуком."""
+    if not block or not os.path.exists(path) or os.path.getsize(path) < len(block):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(block)) == block
@@ -3,6 +3,7 @@
 import time
 import telebot
 import os
+import re
 from telebot import types
 from API import (
     send_search_request_and_print_result,
@@ -15,30 +16,212 @@ from API import (
     folder_audiobooks,
     get_podcast_info,
     download_podcast,
-    folder_podcasts
+    folder_podcasts,
+    download_track,
+    download_playlist,
+    album_kinds,
+    update_podcast,
+    backfill_lyrics,
+    subscribe_podcast,
+    podcasts_with_new_episodes,
+    subscriptions,
+    library
 )
 from dotenv import load_dotenv, find_dotenv
+from archive import archive_parts, build_part, part_name
+from chat_pool import ChatPool
+from job_queue import JobQueue
+from links import parse_links, link_id
+from metrics import metrics, profiler, serve
+from net import limits_stats
+from sessions import SessionStore
+from uploads import UploadCache, file_stamp, files_stamp, small_versions
 import threading
 from loguru import logger
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-start_window = 0
-cur_dir = folder_music
-root_dir = folder_music
-dir_ls = []
-files_ls = []
 load_dotenv(find_dotenv())
-bot = telebot.TeleBot(os.getenv('TELEGRAMM_TOKEN'))
-download_queue = list()
+handlers = ChatPool(int(os.getenv('BOT_THREADS', 4)), max_pending=int(os.getenv('BOT_QUEUE', 1000)))
+
+
+class ChatBot(telebot.TeleBot):
+    """Апдейты разбираются не в потоке опроса, а в пуле handlers с сохранением порядка внутри чата."""
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # offset следующего get_updates сдвигаем сразу, а не когда апдейт обработается
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            handlers.submit(_update_chat(update), super().process_new_updates, [update])
+
+
+def _update_chat(update):
+    """Чат апдейта; апдейты без чата друг от друга не зависят"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return f"update-{update.update_id}"
+
+
+bot = ChatBot(os.getenv('TELEGRAMM_TOKEN'), threaded=False)
+sessions = SessionStore(folder_music,
+                        max_items=int(os.getenv('SESSION_CACHE_SIZE', 1000)),
+                        ttl=int(os.getenv('SESSION_TTL', 3600))) # состояние браузера /files по чатам
+archive_part_size = int(os.getenv('ARCHIVE_PART_MB', 49)) * 1024 * 1024 # Telegram не принимает от бота файлы больше 50 мб
+archive_pool = ThreadPoolExecutor(max_workers=int(os.getenv('ARCHIVE_THREADS', 1)), thread_name_prefix='archive')
+uploads = UploadCache(os.getenv('UPLOADS_DB', f'{folder_music}/.uploads.db')) # file_id отправленных файлов
+upload_limit = int(os.getenv('UPLOAD_LIMIT_MB', 49)) * 1024 * 1024 # файлы больше - пережимаются или режутся на части
+uploads_dir = os.getenv('UPLOADS_DIR', f'{folder_music}/.uploads') # готовые уменьшенные версии больших файлов
+transcode_min_kbps = int(os.getenv('TRANSCODE_MIN_KBPS', 64)) # ниже этого битрейта звук не пережимается, а режется по времени
+transcode_pool = ThreadPoolExecutor(max_workers=int(os.getenv('TRANSCODE_THREADS', 1)), thread_name_prefix='transcode')
+preparing = {} # большой файл, который сейчас уменьшается -> чаты, которым его прислать
+preparing_lock = threading.Lock()
+download_queue = JobQueue(os.getenv('QUEUE_DB', f'{folder_music}/.queue.db'),
+                          keep_days=float(os.getenv('QUEUE_KEEP_DAYS', 7))) # выполненные задачи храним неделю
+download_workers = int(os.getenv('QUEUE_WORKERS', 2)) # сколько задач из очереди качаем одновременно
+sync_playlists = [p.strip() for p in os.getenv('SYNC_PLAYLISTS', '').split(',') if p.strip()] # плейлисты ночной синхронизации
+sync_chat_id = os.getenv('SYNC_CHAT_ID') # куда писать о ночной синхронизации
+sync_hour = int(os.getenv('SYNC_HOUR', 3))
+playlist_arg_re = re.compile(r"likes|[^\s/:]+:(?:\d+|likes)") # /sync без ссылки: likes, owner:kind, owner:likes
+if os.getenv('DOWNLOAD_ENGINE', 'sync') == 'async':
+    import async_engine
+    download_jobs = {
+        'Artist': async_engine.search_and_download_artist,
+        'Album': async_engine.download_album,
+        'Book': async_engine.download_book,
+        'Podcast': async_engine.download_podcast,
+        'Track': download_track, # отдельные треки и плейлисты качаются по альбомам синхронным движком
+        'Playlist': download_playlist,
+        'PodcastUpdate': update_podcast,
+        'Lyrics': backfill_lyrics,
+    }
+else:
+    download_jobs = {
+        'Artist': search_and_download_artist,
+        'Album': download_album,
+        'Book': download_book,
+        'Podcast': download_podcast,
+        'Track': download_track,
+        'Playlist': download_playlist,
+        'PodcastUpdate': update_podcast,
+        'Lyrics': backfill_lyrics,
+    }
+podcast_check_hours = float(os.getenv('PODCAST_CHECK_HOURS', 6)) # как часто проверять подписки на новые выпуски
+metrics_port = int(os.getenv('METRICS_PORT', 0)) # порт HTTP /metrics и /profile, 0 - не запускать
+metrics.gauge('download_queue', lambda: len(download_queue))
+metrics.gauge('bot_pending', lambda: handlers.stats()['pending'])
 
 
 @bot.message_handler(commands=['start'])
 def start_message(message):
     mess = "Привет, хочешь скачать музыку, аудиокниги, подкасты? /download\
-        \nХочешь посмотреть скаченное? /files"
+        \nХочешь посмотреть скаченное? /files\
+        \nМожно просто прислать ссылки на альбомы, треки и плейлисты - сообщением или .txt файлом\
+        \nОбновить плейлист или «Мне нравится»: /sync likes\
+        \nПодписаться на подкаст: /subscribe <ссылка>, подписки: /subscriptions"
     bot.send_message(message.chat.id, mess)
 
 
+@bot.message_handler(commands=['stats'])
+def stats_message(message):
+    """Насколько быстро бот отвечает и сколько закачек в очереди."""
+    stats = handlers.stats()
+    mess = f"Ответы бота: обработано {stats['processed']}, ждут {stats['pending']}, потоков {stats['workers']}\
+        \nзадержка: средняя {stats['avg_latency']} с, p95 {stats['p95_latency']} с, макс. {stats['max_latency']} с\
+        \nзакачек в очереди: {len(download_queue)}"
+    for name, limit in limits_stats().items():
+        mess += f"\n{name}: {limit['actual']} запр./с (темп {limit['rate']} из {limit['limit']}), запросов {limit['requests']}," \
+                f" 429/5xx {limit['throttled']}, повторов {limit['retried']}, ожидание {limit['waited']} с"
+    upload_stats = uploads.stats()
+    mess += f"\nотправка файлов: по file_id {upload_stats['hits']}, загружено {upload_stats['misses']}, в кэше {upload_stats['files']}"
+    mess += '\n' + metrics.summary()
+    bot.send_message(message.chat.id, mess)
+
+
+@bot.message_handler(commands=['profile'])
+def profile_message(message):
+    """/profile on - включить профайлер, /profile off - выключить, /profile - где сейчас больше всего времени."""
+    arg = message.text.partition(' ')[2].strip()
+    if arg == 'on':
+        profiler.start()
+    elif arg == 'off':
+        profiler.stop()
+    top = profiler.top(15)
+    mess = f"Профайлер {'включён' if profiler.running else 'выключен'}, замеров: {profiler.total}"
+    bot.send_message(message.chat.id, mess + ('\n' + '\n'.join(top) if top else ''))
+
+
+
+@bot.message_handler(commands=['sync'])
+def sync_message(message):
+    """/sync - синхронизировать плейлисты из SYNC_PLAYLISTS, /sync <ссылки>, /sync likes или /sync owner:kind - выбранные."""
+    args, playlist_ids = message.text.split()[1:], []
+    for arg in args:
+        links = parse_links(arg) # ссылки - как в обычном сообщении, без ссылки - только likes и owner:kind
+        if links:
+            playlist_ids += [item_id for kind, item_id in links if kind == 'playlist']
+        elif playlist_arg_re.fullmatch(arg):
+            playlist_ids.append(arg)
+        else:
+            bot.send_message(message.chat.id, f"Не понял, что за плейлист: {arg}\nНапример: /sync likes или ссылка на плейлист")
+            return
+    if args and not playlist_ids:
+        bot.send_message(message.chat.id, "В ссылках нет плейлистов. Например: /sync https://music.yandex.ru/users/.../playlists/3")
+        return
+    playlist_ids = playlist_ids or sync_playlists
+    if not playlist_ids:
+        bot.send_message(message.chat.id, "Какой плейлист? Например: /sync likes")
+        return
+    added, queue_len = download_queue.put_many([('Playlist', playlist_id) for playlist_id in playlist_ids], message.chat.id)
+    bot.send_message(message.chat.id, f"Синхронизация плейлистов в очереди: {added}\nВсего в очереди: {queue_len} задачи")
+
+
+@bot.message_handler(commands=['lyrics'])
+def lyrics_message(message):
+    """/lyrics - докачать тексты песен ко всей уже скачанной музыке."""
+    added, queue_len = download_queue.put_many([('Lyrics', folder_music)], message.chat.id)
+    bot.send_message(message.chat.id, f"{'Поставил' if added else 'Уже стоит'} в очередь поиск текстов песен.\nВсего в очереди: {queue_len} задачи")
+
+
+@bot.message_handler(commands=['subscribe'])
+def subscribe_message(message):
+    """/subscribe <ссылка на подкаст> - новые выпуски будут качаться сами."""
+    podcast_id = link_id(message.text.partition(' ')[2])
+    subscribed = subscribe_podcast(podcast_id, message.chat.id) if podcast_id else None
+    if subscribed is False:
+        bot.send_message(message.chat.id, "Это не подкаст: подписаться можно только на подкаст")
+        return
+    if subscribed is None:
+        bot.send_message(message.chat.id, "Пришли ссылку на подкаст: /subscribe https://music.yandex.ru/album/...")
+        return
+    title, is_new = subscribed
+    if not is_new:
+        bot.send_message(message.chat.id, f"Ты уже подписан на {title}")
+        return
+    queue_len = download_queue.put('PodcastUpdate', podcast_id, message.chat.id) # сразу докачиваем всё, что уже вышло
+    bot.send_message(message.chat.id, f"Подписал на {title}, новые выпуски скачаю сам.\nВсего в очереди: {queue_len} задачи")
+
+
+@bot.message_handler(commands=['unsubscribe'])
+def unsubscribe_message(message):
+    podcast_id = link_id(message.text.partition(' ')[2])
+    if podcast_id and subscriptions.remove(podcast_id, message.chat.id):
+        bot.send_message(message.chat.id, "Отписал, скачанные выпуски остались на месте")
+    else:
+        bot.send_message(message.chat.id, "Такой подписки нет, список: /subscriptions")
+
+
+@bot.message_handler(commands=['subscriptions'])
+def subscriptions_message(message):
+    subs = subscriptions.list(message.chat.id)
+    if not subs:
+        bot.send_message(message.chat.id, "Подписок нет. Подписаться: /subscribe <ссылка на подкаст>")
+        return
+    bot.send_message(message.chat.id, '\n'.join(f"{title} ({track_count} вып.) - /unsubscribe {podcast_id}"
+                                                for podcast_id, title, track_count in subs))
+
 
 @bot.message_handler(commands=['download'])
 def download_command(message):
@@ -101,7 +284,7 @@ def input_data_artist(message):
 def input_data_albom(message):
     """Обрабатывает сообщение, запрашивает у пользователя информацию о альбоме."""
     try:
-        album_id = ''.join([x for x in message.text if x.isdigit()])
+        album_id = link_id(message.text)
         print('Album_id: ', album_id)
         album_mess = get_album_info(album_id=album_id)
         bot.send_message(message.chat.id, album_mess)
@@ -121,7 +304,7 @@ def input_data_albom(message):
 def input_data_book(message):
     """Обрабатывает сообщение, запрашивает у пользователя информацию о аудиокниге."""
     try:
-        book_id = ''.join([x for x in message.text if x.isdigit()])
+        book_id = link_id(message.text)
         book_mess = get_book_info(album_id=book_id)
         bot.send_message(message.chat.id, book_mess)
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
@@ -140,7 +323,7 @@ def input_data_book(message):
 def input_data_podcast(message):
     """Обрабатывает сообщение, запрашивает у пользователя информацию о подкасте."""
     try:
-        podcast_id = ''.join([x for x in message.text if x.isdigit()])
+        podcast_id = link_id(message.text)
         podcast_mess = get_podcast_info(podcast_id=podcast_id)
         bot.send_message(message.chat.id, podcast_mess)
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
@@ -160,15 +343,8 @@ def download_from_input_data(message, *args):
     """Добавляет закачку в очередь."""
     try:
         if message.text == 'Качаем!':
-            if args[0] == 'Artist':
-                download_queue.append((search_and_download_artist, args[1], message.chat.id))
-            elif args[0] == 'Album':
-                download_queue.append((download_album, args[1], message.chat.id))
-            elif args[0] == 'Book':
-                download_queue.append((download_book, args[1], message.chat.id))
-            elif args[0] == 'Podcast':
-                download_queue.append((download_podcast, args[1], message.chat.id))
-            bot.send_message(message.chat.id, f"Добавил закачку в очередь.\nВсего в очереди: {len(download_queue)} задачи")
+            queue_len = download_queue.put(args[0], args[1], message.chat.id)
+            bot.send_message(message.chat.id, f"Добавил закачку в очередь.\nВсего в очереди: {queue_len} задачи")
         else:
             bot.send_message(message.chat.id, f"Не хочешь? Можешь скачать что-то другое.")
     except:
@@ -177,24 +353,165 @@ def download_from_input_data(message, *args):
             bot.send_document(message.chat.id, file)
 
 
+def enqueue_links(chat_id, text):
+    """Ставит в очередь все ссылки из текста разом: уже скачанное и уже стоящее в очереди пропускаем."""
+    links = parse_links(text)
+    if not links:
+        bot.send_message(chat_id, "Не нашёл ссылок на Яндекс Музыку")
+        return
+    kinds = album_kinds([item_id for kind, item_id in links if kind == 'album'])
+    jobs, downloaded = [], 0
+    for kind, item_id in links:
+        if kind == 'album':
+            if item_id not in kinds: # такого альбома нет
+                continue
+            album_kind, is_downloaded = kinds[item_id]
+            if is_downloaded:
+                downloaded += 1
+                continue
+            jobs.append((album_kind, item_id))
+        else:
+            jobs.append((kind.capitalize(), item_id))
+    added, queue_len = download_queue.put_many(jobs, chat_id)
+    mess = f"Ссылок: {len(links)}, добавил в очередь: {added}"
+    if len(jobs) > added:
+        mess += f"\nуже в очереди: {len(jobs) - added}"
+    if downloaded:
+        mess += f"\nуже скачано: {downloaded}"
+    if len(links) > len(jobs) + downloaded:
+        mess += f"\nне нашёл в Яндекс Музыке: {len(links) - len(jobs) - downloaded}"
+    bot.send_message(chat_id, mess + f"\nВсего в очереди: {queue_len} задачи")
+    logger.info(f"Пользователь {chat_id} прислал {len(links)} ссылок, в очередь добавлено {added}")
+
+
+@bot.message_handler(func=lambda message: 'music.yandex' in (message.text or ''))
+def links_message(message):
+    """Ссылки, присланные без /download, сразу ставим в очередь."""
+    try:
+        enqueue_links(message.chat.id, message.text)
+    except:
+        logger.exception(f"Не удалось добавить ссылки пользователя {message.chat.id}")
+        bot.send_message(message.chat.id, "Что-то пошло не так при добавлении в очередь. Посмотри log")
+
+
+@bot.message_handler(content_types=['document'])
+def links_file(message):
+    """Текстовый файл со списком ссылок."""
+    try:
+        data = bot.download_file(bot.get_file(message.document.file_id).file_path)
+        enqueue_links(message.chat.id, data.decode('utf-8', errors='ignore'))
+    except:
+        logger.exception(f"Не удалось прочитать файл ссылок пользователя {message.chat.id}")
+        bot.send_message(message.chat.id, "Не смог прочитать файл, нужен текст со ссылками")
+
+
 def download_monitor():
-    """Основной цикл скачивания."""
+    """Основной цикл скачивания: ждём задачу в очереди и качаем её."""
     while True:
-        time.sleep(10)
-        if download_queue != []:
-            data = download_queue[0]
-            try:
-                result = data[0](data[1])
-                bot.send_message(chat_id=data[2], text=result)
-            except:
-                bot.send_message(chat_id=data[2], text=f"Что-то пошло не так при скачивании ID:{data[1]}. Посмотри log")
-            download_queue.pop(0)
-            bot.send_message(data[2], f"Всего осталось в очереди: {len(download_queue)} задачи")
+        job_id, kind, arg, chat_id = download_queue.get()
+        result = None
+        try:
+            with metrics.timer('job_seconds', kind=kind):
+                result = download_jobs[kind](arg)
+            if result is None: # ошибку уже поймал и записал в лог logger.catch
+                bot.send_message(chat_id=chat_id, text=f"Что-то пошло не так при скачивании ID:{arg}. Посмотри log")
+            else:
+                bot.send_message(chat_id=chat_id, text=result)
+        except:
+            bot.send_message(chat_id=chat_id, text=f"Что-то пошло не так при скачивании ID:{arg}. Посмотри log")
+        finally:
+            download_queue.done(job_id, result, ok=result is not None)
+            metrics.inc('jobs_total', kind=kind, status='ok' if result is not None else 'failed')
+        bot.send_message(chat_id, f"Всего осталось в очереди: {len(download_queue)} задачи")
+
+
+def send_cached(chat_id, key, stamp, data, name=None):
+    """Шлём документ по file_id из кэша, а если его там нет - загружаем data() и запоминаем file_id."""
+    file_id = uploads.get(key, stamp)
+    if file_id:
+        try:
+            return bot.send_document(chat_id, file_id)
+        except telebot.apihelper.ApiTelegramException:
+            logger.warning(f"file_id {key} не принят, загружаю заново")
+            uploads.forget(key)
+    document = data()
+    try:
+        msg = bot.send_document(chat_id, document, visible_file_name=name)
+    finally:
+        document.close()
+    uploads.put(key, stamp, (msg.document or msg.audio).file_id)
+    return msg
+
+
+def send_file(chat_id, path):
+    """Шлём файл из /files: по file_id, если его уже отправляли, большой - уменьшенным в фоне."""
+    stamp = file_stamp(path)
+    if os.path.getsize(path) <= upload_limit:
+        send_cached(chat_id, path, stamp, partial(open, path, 'rb'))
+        return
+    with preparing_lock:
+        busy = path in preparing # уже уменьшается для другого чата - пришлём и этому
+        preparing.setdefault(path, []).append(chat_id)
+    if not busy:
+        transcode_pool.submit(send_small_versions, path)
+    bot.send_message(chat_id, "Файл больше 50 мб: пришлю уменьшенную копию или по частям, как будет готово")
+
+
+@logger.catch
+def send_small_versions(path):
+    """Уменьшаем большой файл (или берём готовое с прошлого раза) и шлём всем чатам, которые его ждут."""
+    try:
+        how, files = small_versions(path, upload_limit, uploads_dir, transcode_min_kbps)
+        stamp = file_stamp(path)
+    except Exception:
+        with preparing_lock:
+            chats = preparing.pop(path)
+        for chat_id in chats:
+            bot.send_message(chat_id, f"Не удалось подготовить {os.path.basename(path)}")
+        raise
+    with preparing_lock:
+        chats = preparing.pop(path)
+    for chat_id in chats:
+        try:
+            for part in files:
+                send_cached(chat_id, f"{path}#{os.path.basename(part)}", stamp, partial(open, part, 'rb'))
+        except telebot.apihelper.ApiTelegramException:
+            bot.send_message(chat_id, f"Не удалось отправить {os.path.basename(path)}")
+            logger.exception(f"Пользователь {chat_id} не смог скачать {path}")
+            continue
+        if how == 'split':
+            name = os.path.basename(path)
+            bot.send_message(chat_id, f"{name} разрезан на части ({len(files)} шт.), собрать: cat \"{name}\".* > \"{name}\"")
+        logger.info(f"File {path} sended as {how}: {len(files)} files")
+
+
+@logger.catch
+def send_folder_archive(chat_id, cur_dir):
+    """Шлём папку zip-архивом по частям меньше лимита Telegram, каждая часть собирается в памяти.
+
+    Часть, которую уже отправляли и файлы которой не менялись, уходит по file_id и не собирается.
+    """
+    parts, too_big = archive_parts(cur_dir, archive_part_size)
+    for number, files in enumerate(parts, 1):
+        name = part_name(cur_dir, number, len(parts))
+        try:
+            send_cached(chat_id, f"{os.path.abspath(cur_dir)}#zip{number}/{len(parts)}",
+                        files_stamp([path for path, _ in files]), partial(build_part, files), name)
+        except telebot.apihelper.ApiTelegramException:
+            bot.send_message(chat_id, f"Не удалось отправить {name}")
+            logger.exception(f"Пользователь {chat_id} не смог скачать архив {name} каталога {cur_dir}")
+    if too_big:
+        bot.send_message(chat_id, "Не влезли в архив (больше 50 мб), пришлю отдельно: " + ', '.join(os.path.basename(path) for path in too_big))
+        for path in too_big:
+            send_file(chat_id, path)
+    if not parts and not too_big:
+        bot.send_message(chat_id, "Папка пуста")
+    logger.info(f"Пользователь {chat_id} скачал архив с содержимим каталога {cur_dir}: частей {len(parts)}, не влезло {len(too_big)}")
 
 
 @bot.message_handler(commands=['files'])
 def what_files(message):
-    start_window = 0
+    sessions.pop(message.chat.id) # браузер открывается заново
     markup = types.InlineKeyboardMarkup()
     item1 = types.InlineKeyboardButton(text='Музыка', callback_data='files_music')
     item2 = types.InlineKeyboardButton(text='Аудиокнига', callback_data='files_book')
@@ -207,93 +524,84 @@ def what_files(message):
 @bot.callback_query_handler(func=lambda call: True)
 def callback_inline(call):
     """обработчик команды files. Отображает файловый менеджер с возможностью скачивать."""
-    global cur_dir
-    global root_dir
-    global dir_ls
-    global files_ls
-    global start_window
+    session = sessions.get(call.message.chat.id) # папка и страница у каждого чата свои
     block_send_status = False
     if call.data == 'Exit':
         block_send_status = True
+        sessions.pop(call.message.chat.id)
         bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
         bot.send_message(call.message.chat.id, "Не хочешь... Как хочешь!", reply_markup=None)
         logger.info(f"Пользователь {call.message.chat.id} закрыл инлайн меню просмотра файлов")
     elif call.data == 'DownloadFolder':
         block_send_status = True
-        if os.path.abspath(cur_dir) != os.path.abspath(root_dir):
-            send_temp_file = root_dir + cur_dir[cur_dir.rfind('/'):]
-            shutil.make_archive(send_temp_file, 'zip', cur_dir)
-            try:
-                with open(f'{send_temp_file}.zip', 'rb') as f:
-                    bot.send_document(call.message.chat.id, f)
-                logger.info(f"Пользователь {call.message.chat.id} скачал архив с содержимим каталога {cur_dir}")
-            except telebot.apihelper.ApiTelegramException:
-                bot.send_message(call.message.chat.id, "сработало ограничение в 50 мб")
-                logger.info(f"Пользователь {call.message.chat.id} не смог скачать архив с содержимим каталога {cur_dir}. Сработало ограничение в 50 мб")
-            finally:
-                os.remove(path=f'{send_temp_file}.zip')
+        if os.path.abspath(session.cur_dir) != os.path.abspath(session.root_dir):
+            # архив собирается и отправляется в своём пуле, поток бота сразу свободен
+            archive_pool.submit(send_folder_archive, call.message.chat.id, session.cur_dir)
+            bot.send_message(call.message.chat.id, "Собираю архив, пришлю частями до 50 мб", reply_markup=None)
         else:
             bot.send_message(call.message.chat.id, "Нельзя качать в корневом каталоге!", reply_markup=None)
 
     else:
         if call.data == 'files_music':
-            cur_dir = folder_music
-            root_dir = folder_music
+            session.open(folder_music, root_dir=folder_music)
             
         elif call.data == "files_book":
-            cur_dir = folder_audiobooks
-            root_dir = folder_audiobooks
+            session.open(folder_audiobooks, root_dir=folder_audiobooks)
             
         elif call.data == "files_podcast":
-            cur_dir = folder_podcasts
-            root_dir = folder_podcasts
+            session.open(folder_podcasts, root_dir=folder_podcasts)
 
         elif call.data == 'Back':
-            start_window = 0
-            if os.path.abspath(cur_dir) != os.path.abspath(root_dir):
-                cur_dir = os.path.join(cur_dir, '..')
+            if os.path.abspath(session.cur_dir) != os.path.abspath(session.root_dir):
+                session.open(os.path.dirname(os.path.abspath(session.cur_dir)))
             else:
+                session.start_window = 0
                 bot.send_message(call.message.chat.id, "Ты в корневом каталоге! Выше нельзя", reply_markup=None)
         
         elif call.data == 'PrevP':
-            start_window -= 15
-            if start_window < 0:
-                start_window = 0
+            session.start_window -= 15
+            if session.start_window < 0:
+                session.start_window = 0
         elif call.data == 'NextP':
-            if start_window + 15 < len(dir_ls + files_ls):
-                start_window += 15
+            if session.listing is not None and session.start_window + 15 < len(session.listing):
+                session.start_window += 15
             else:
-                bot.send_message(call.message.chat.id, "Нет больше файлов", reply_markup=None)
+                bot.send_message(call.message.chat.id, "Нет больше файлов", reply_markup=None)
 
-        elif call.data in [''.join([y for y in x if y.isalnum()])[:15] for x in dir_ls]:
-            for _ in dir_ls:
-                if call.data == ''.join([y for y in _ if y.isalnum()])[:15]:
-                    cur_dir = os.path.join(cur_dir, _)
-            start_window = 0
+        elif call.data.startswith('dir:'):
+            entry = library.get(int(call.data[4:]))
+            if entry:
+                session.open(entry[0])
 
-        elif call.data in [''.join([y for y in x if y.isalnum()])[:15] for x in files_ls]:
+        elif call.data.startswith('file:'):
             block_send_status = True
-            for _ in files_ls:
-                if call.data == ''.join([y for y in _ if y.isalnum()])[:15]:
-                    send_file = cur_dir + '/' + _
-                    print(send_file)
-
+            entry = library.get(int(call.data[5:]))
+            send_file_path = entry[0] if entry else ''
             try:
-                with open(f'{send_file}', 'rb') as f:
-                    bot.send_document(call.message.chat.id, f)
-                logger.info(f"File {send_file} sended!!!")
+                send_file(call.message.chat.id, send_file_path)
+                logger.info(f"File {send_file_path} sended!!!")
             except telebot.apihelper.ApiTelegramException:
-                bot.send_message(call.message.chat.id, "сработало ограничение в 50 мб")
-                logger.error(f"сработало ограничение в 50 мб: {send_file} > 50 мб")
+                bot.send_message(call.message.chat.id, "Не удалось отправить файл")
+                logger.exception(f"Не удалось отправить {send_file_path}")
+            except FileNotFoundError:
+                bot.send_message(call.message.chat.id, "Файла уже нет")
+                library.refresh(session.cur_dir)
+                session.listing = None
 
     if not block_send_status:
-        dir_ls = sorted([folder for folder in os.listdir(cur_dir) if os.path.isdir(cur_dir+'/'+folder)])
-        files_ls = sorted([filee for filee in os.listdir(cur_dir) if os.path.isfile(cur_dir+'/'+filee)])
-        mess = os.path.abspath(cur_dir).replace(os.path.abspath(root_dir), '') 
+        if session.listing is None:
+            if not os.path.isdir(session.cur_dir): # папку удалили, пока её смотрели
+                session.open(session.root_dir)
+            # индекс перечитывает папку с диска, только если она изменилась,
+            # а листание страниц дальше идёт по списку в сессии
+            library.refresh(session.cur_dir)
+            session.listing = library.list(session.cur_dir, limit=-1)
+        mess = os.path.abspath(session.cur_dir).replace(os.path.abspath(session.root_dir), '') 
         markup = types.InlineKeyboardMarkup()
-        dirs_buttons = [types.InlineKeyboardButton(text='📁 '+folder, callback_data=''.join([x for x in folder if x.isalnum()])[:15]) for folder in dir_ls]
-        files_buttons = [types.InlineKeyboardButton(text='💾 '+filee, callback_data=''.join([x for x in filee if x.isalnum()])[:15]) for filee in files_ls]
-        item_inwindow_buttons = (dirs_buttons + files_buttons)[start_window:start_window+15]
+        # в callback_data постоянный id записи индекса: одинаковые начала имён больше не путаются
+        item_inwindow_buttons = [types.InlineKeyboardButton(text='📁 '+name, callback_data=f'dir:{entry_id}') if is_dir
+                                 else types.InlineKeyboardButton(text='💾 '+name, callback_data=f'file:{entry_id}')
+                                 for entry_id, name, is_dir in session.listing[session.start_window:session.start_window+15]]
     
         back_button = types.InlineKeyboardButton(text='⬅️ НАЗАД', callback_data='Back')
         exit_button = types.InlineKeyboardButton(text='❌ ВЫХОД', callback_data='Exit')
@@ -303,32 +611,63 @@ def callback_inline(call):
         next_page_button = types.InlineKeyboardButton(text='▶️ След.стр.', callback_data='NextP')
         
         markup.add(download_button, back_button, exit_button, *item_inwindow_buttons)
-        if len(dirs_buttons + files_buttons) > 15:
+        if len(session.listing) > 15:
             markup.add(prev_page_button, next_page_button)
         bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text='/'+mess, reply_markup=markup)
     elif block_send_status:
         block_send_status = False
+def sync_monitor():
+    """Раз в сутки в SYNC_HOUR ставит в очередь синхронизацию плейлистов из SYNC_PLAYLISTS."""
+    while True:
+        now = time.localtime()
+        wait = (sync_hour - now.tm_hour) * 3600 - now.tm_min * 60 - now.tm_sec
+        time.sleep(wait if wait > 0 else wait + 24 * 3600)
+        added, queue_len = download_queue.put_many([('Playlist', playlist_id) for playlist_id in sync_playlists], int(sync_chat_id))
+        logger.info(f"Nightly sync: playlists queued {added}, queue {queue_len}")
+
+
+def podcast_monitor():
+    """Раз в PODCAST_CHECK_HOURS ставит в очередь подкасты из подписок, у которых вышли новые выпуски."""
+    while True:
+        time.sleep(podcast_check_hours * 3600)
+        try:
+            for podcast_id, chats in podcasts_with_new_episodes().items():
+                download_queue.put_many([('PodcastUpdate', podcast_id)], chats[0]) # качаем один раз, на первый чат
+                for chat_id in chats[1:]:
+                    bot.send_message(chat_id, f"Вышли новые выпуски подкаста {podcast_id}, качаю")
+        except Exception:
+            logger.exception("Podcast subscriptions check failed")
+
+
 @logger.catch
 def echo_status(downloader_status, bot_status):
     while True:
+        downloaders_alive = sum(thread.is_alive() for thread in downloader_status)
         if not downloader_status or not bot_status:
-            mess = f"Внимание!!!\nСтатус потока скачивания: {downloader_status.is_alive()}\nСтатус потока бота: {bot_status.is_alive()}"
+            mess = f"Внимание!!!\nСтатус потоков скачивания: {downloaders_alive} из {len(downloader_status)}\nСтатус потока бота: {bot_status.is_alive()}"
             logger.error(mess)
             time.sleep(600)
             bot_thread.start()
         else:
-            mess = f"\nСтатус потока скачивания: {downloader_status.is_alive()}\nСтатус потока бота: {bot_status.is_alive()}"
+            mess = f"\nСтатус потоков скачивания: {downloaders_alive} из {len(downloader_status)}\nСтатус потока бота: {bot_status.is_alive()}"
             logger.info(mess)
+            logger.info(f"Bot handlers: {handlers.stats()}")
             time.sleep(3600)
 
 
 if __name__ == '__main__':
-    download_monitor_thread = threading.Thread(target=download_monitor)
-    download_monitor_thread.start() # запуск потока скачивания медиафайлов
+    download_monitor_threads = [threading.Thread(target=download_monitor, name=f'download-{n}') for n in range(download_workers)]
+    for download_monitor_thread in download_monitor_threads:
+        download_monitor_thread.start() # запуск потоков скачивания медиафайлов
+    if metrics_port:
+        serve(metrics_port, os.getenv('METRICS_HOST', '127.0.0.1')) # метрики для Prometheus
+    if sync_playlists and sync_chat_id:
+        threading.Thread(target=sync_monitor, name='sync', daemon=True).start() # ночная синхронизация плейлистов
+    threading.Thread(target=podcast_monitor, name='podcasts', daemon=True).start() # проверка подписок на подкасты
     bot_thread = threading.Thread(target=bot.infinity_polling, kwargs={'skip_pending':True})
     bot_thread.start() # запуск бота в отдельном потоке
     echo_status_thread = threading.Thread(target=echo_status, kwargs={
-        'downloader_status': download_monitor_thread,
+        'downloader_status': download_monitor_threads,
         'bot_status': bot_thread})
     echo_status_thread.start()
     
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+import threading
+try:
+    import fcntl
+except ImportError: # не Linux - reflink недоступен, будет обычная копия
+    fcntl = None
+
+FICLONE = 0x40049409 # ioctl reflink-копии (btrfs, xfs)
+
+
+class TrackStore:
+    """Какие треки уже лежат в медиатеке: id трека Яндекса -> файлы с ним, sha1 и размер звука.
+
+    Один и тот же трек приходит с сингла, альбома, делюкс-издания и сборника;
+    по этому индексу следующая копия берётся с диска, а не из сети. Совпадение ищется только по id трека:
+    sha1 звука известен лишь после закачки, так что тот же звук под новым id (переиздание) качается заново.
+    В индекс попадают только готовые файлы - с записанными тэгами.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                track_id TEXT NOT NULL,
+                sha1 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                bitrate INTEGER
+            )""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tracks_id ON tracks (track_id)")
+            self.db.execute("DROP INDEX IF EXISTS tracks_sha1") # ищем только по track_id, индекс по sha1 не нужен
+            self.db.commit()
+
+    def add(self, track_id, path, sha1, size, bitrate=None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO tracks (path, track_id, sha1, size, bitrate) VALUES (?, ?, ?, ?, ?)",
+                            (os.path.abspath(path), str(track_id), sha1, size, bitrate))
+            self.db.commit()
+
+    def find(self, track_id, exclude=None):
+        """Готовый файл трека, кроме exclude: (путь, sha1 звука, размер звука, битрейт) или None.
+
+        Файлы, которых уже нет на диске, из индекса удаляются.
+        """
+        exclude = exclude and os.path.abspath(exclude)
+        with self.lock:
+            rows = self.db.execute("SELECT path, sha1, size, bitrate FROM tracks WHERE track_id = ?",
+                                   (str(track_id),)).fetchall()
+        for row in rows:
+            if row[0] == exclude:
+                continue
+            if os.path.exists(row[0]):
+                return row
+            with self.lock:
+                self.db.execute("DELETE FROM tracks WHERE path = ?", (row[0],))
+                self.db.commit()
+        return None
+
+
+def clone_file(source, target):
+    """Копия файла без сети: reflink (общие с source блоки на диске), если ФС умеет, иначе обычная копия.
+
+    Возвращает True, если получился reflink.
+    """
+    if fcntl is not None:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return True
+            except OSError:
+                pass
+    shutil.copyfile(source, target)
+    return False
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+import mutagen
+
+ffmpeg = shutil.which(os.getenv('FFMPEG', 'ffmpeg')) # без ffmpeg большие файлы только режутся на куски
+
+
+class UploadCache:
+    """file_id уже отправленных в Telegram файлов в SQLite: повторная отправка идёт по file_id, без загрузки файла.
+
+    Запись действительна, пока не изменился stamp (для файла - mtime и размер): перезаписанный
+    или перетэгированный файл загрузится заново. file_id у бота общий на все чаты.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                key TEXT PRIMARY KEY,
+                stamp TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                sent REAL NOT NULL
+            )""")
+            self.db.commit()
+
+    def get(self, key, stamp):
+        """file_id для key, None - если его нет или файл с тех пор изменился."""
+        with self.lock:
+            row = self.db.execute("SELECT file_id FROM uploads WHERE key = ? AND stamp = ?", (key, stamp)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, stamp, file_id):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO uploads (key, stamp, file_id, sent) VALUES (?, ?, ?, ?)",
+                            (key, stamp, file_id, time.time()))
+            self.db.commit()
+
+    def forget(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            count = self.db.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+            return {'files': count, 'hits': self.hits, 'misses': self.misses}
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def files_stamp(paths):
+    """Общий stamp нескольких файлов (части архива папки)"""
+    return hashlib.sha1('\n'.join(f"{path}|{file_stamp(path)}" for path in paths).encode()).hexdigest()
+
+
+def small_versions(path, limit, folder, min_kbps=64):
+    """Файл больше limit в виде, который Telegram примет: (как сделано, список файлов не больше limit каждый).
+
+    Звук с ffmpeg пережимается в битрейт, при котором он влезает в limit ('transcoded'),
+    а если битрейт выходит ниже min_kbps - режется по времени на части без перекодирования ('segments').
+    Без ffmpeg, не звук или если не вышло - режется на куски name.001, name.002... ('split'), их надо склеить.
+    Готовое лежит в folder и при следующем запросе того же файла берётся оттуда.
+    """
+    st = os.stat(path)
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    target = os.path.join(folder, f"{key}-{st.st_mtime_ns}")
+    if os.path.isdir(target):
+        return _listed(target)
+    os.makedirs(folder, exist_ok=True)
+    for name in os.listdir(folder):
+        if name.startswith(f"{key}-"): # версии файла, который с тех пор изменился
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+    tmp = target + '.tmp'
+    os.makedirs(tmp)
+    try:
+        how = _make_small(path, st.st_size, limit, tmp, min_kbps)
+        with open(os.path.join(tmp, '.how'), 'w') as f:
+            f.write(how)
+        os.replace(tmp, target)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return _listed(target)
+
+
+def _listed(target):
+    with open(os.path.join(target, '.how')) as f:
+        how = f.read()
+    return how, [os.path.join(target, name) for name in sorted(os.listdir(target)) if not name.startswith('.')]
+
+
+def _make_small(path, size, limit, folder, min_kbps):
+    stem, ext = os.path.splitext(os.path.basename(path))
+    duration = _duration(path) if ffmpeg else None
+    if duration:
+        budget = limit * 0.95 # запас на тэги и неточность битрейта
+        kbps = int(budget * 8 / duration / 1000)
+        try:
+            if kbps >= min_kbps:
+                _ffmpeg('-i', path, '-map', '0:a', '-map_metadata', '0', '-c:a', 'libmp3lame', '-b:a', f"{kbps}k",
+                        os.path.join(folder, f"{stem} ({kbps} kbps).mp3"))
+                how = 'transcoded'
+            else:
+                _ffmpeg('-i', path, '-map', '0:a', '-c', 'copy', '-f', 'segment', '-segment_time',
+                        str(max(1, int(duration * budget / size))), '-segment_start_number', '1', '-reset_timestamps', '1',
+                        os.path.join(folder, f"{stem} (часть %02d){ext}"))
+                how = 'segments'
+            if all(os.path.getsize(os.path.join(folder, name)) <= limit for name in os.listdir(folder)):
+                return how
+        except subprocess.CalledProcessError:
+            pass
+        for name in os.listdir(folder): # не влезло или ffmpeg не справился - режем как есть
+            os.remove(os.path.join(folder, name))
+    _split(path, limit, folder)
+    return 'split'
+
+
+def _duration(path):
+    """Длительность звука в секундах, None - если это не звук"""
+    try:
+        audio = mutagen.File(path)
+    except mutagen.MutagenError:
+        return None
+    return audio.info.length if audio is not None and audio.info.length else None
+
+
+def _ffmpeg(*args):
+    subprocess.run([ffmpeg, '-v', 'error', '-y', '-nostdin', *args], check=True, capture_output=True)
+
+
+def _split(path, limit, folder):
+    """Режем файл на куски по limit байт, читая его по мегабайту"""
+    name = os.path.basename(path)
+    with open(path, 'rb') as src:
+        number = 1
+        chunk = src.read(min(limit, 1024 * 1024))
+        while chunk:
+            with open(os.path.join(folder, f"{name}.{number:03}"), 'wb') as dst:
+                written = 0
+                while chunk:
+                    dst.write(chunk)
+                    written += len(chunk)
+                    chunk = src.read(min(limit - written, 1024 * 1024)) if written < limit else b''
+            chunk = src.read(min(limit, 1024 * 1024))
+            number += 1